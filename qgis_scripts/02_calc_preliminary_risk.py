@@ -1,7 +1,71 @@
 import os
 import processing
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from scipy.ndimage import maximum_filter
 from qgis.core import QgsProject, QgsRasterLayer
 
+# GDALのブロック圧縮/伸長を全コアで行う
+os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS")
+
+# numexprがあればキャッシュブロッキング＋マルチスレッドの要素演算に使う
+try:
+    import numexpr as ne
+    HAS_NUMEXPR = True
+except ImportError:
+    HAS_NUMEXPR = False
+
+# Numbaがあれば並列JIT版の最大値フィルタを使う（無ければscipyにフォールバック）
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(cache=True)
+    def _running_max_1d(line, k, out):
+        """単調デック（リングバッファ）による1次元の移動最大。O(n)、カーネル幅に依存しない。"""
+        n = line.shape[0]
+        half = k // 2
+        idx = np.empty(n, dtype=np.int64)
+        head = 0
+        tail = 0  # 有効区間は [head, tail)
+        for j in range(n + half):
+            if j < n:
+                v = line[j]
+                while tail > head and line[idx[tail - 1]] <= v:
+                    tail -= 1
+                idx[tail] = j
+                tail += 1
+            i = j - half
+            if i >= 0:
+                while idx[head] < i - half:
+                    head += 1
+                out[i] = line[idx[head]]
+
+    @njit(parallel=True, cache=True)
+    def _maxfilt2d(arr, k):
+        """分離可能な2パス（行→列）の最大値フィルタ。行/列単位で並列化する。
+
+        端は窓を切り詰める＝scipyの mode='nearest' と同じ結果になる。
+        """
+        rows, cols = arr.shape
+        tmp = np.empty_like(arr)
+        out = np.empty_like(arr)
+        for i in prange(rows):
+            _running_max_1d(arr[i], k, tmp[i])
+        for j in prange(cols):
+            col = np.empty(rows, dtype=arr.dtype)
+            res = np.empty(rows, dtype=arr.dtype)
+            for i in range(rows):
+                col[i] = tmp[i, j]
+            _running_max_1d(col, k, res)
+            for i in range(rows):
+                out[i, j] = res[i]
+        return out
+
 def calculate_preliminary_risk(output_dir, input_raster_path):
     """
     建物高さラスタから近傍最大高さを計算し、Risk Proxy および SVF Proxy を算出する。
@@ -35,7 +99,10 @@ def calculate_preliminary_risk(output_dir, input_raster_path):
     print(f"▶ セルサイズ: {cell_size_x:.3f} m × {cell_size_y:.3f} m")
 
 
-    # --------- 2. r.neighbors で局所最大高さ（30m近傍） ---------
+    # --------- 2. 局所最大高さ（30m近傍） ---------
+    # GRASS r.neighbors はランタイム起動＋mapset経由のI/Oを伴う汎用フィルタなので、
+    # 単純な正方窓の最大値には scipy.ndimage.maximum_filter（分離可能な1次元max）で
+    # メモリ上の配列を直接処理する。
     RADIUS_M = 30.0
     kernel_half = max(1, int(round(RADIUS_M / cell_size_x)))
     kernel_size = kernel_half * 2 + 1   # 奇数に
@@ -44,90 +111,122 @@ def calculate_preliminary_risk(output_dir, input_raster_path):
 
     localmax_path = os.path.join(output_dir, f"{layer_name}_localmax.tif")
 
-    print("[*] GRASS r.neighbors で局所最大高さを計算中...")
-    params_neighbors = {
-        "input": input_raster_path,
-        "selection": None,
-        "method": 6,      # 6 = maximum
-        "size": kernel_size,
-        "quantile": 0.5,
-        "weight": "",
-        "output": localmax_path,
-        "GRASS_REGION_PARAMETER": None,
-        "GRASS_REGION_CELLSIZE_PARAMETER": 0,
-        "GRASS_RASTER_FORMAT_OPT": "",
-        "GRASS_RASTER_FORMAT_META": ""
-    }
-    processing.run("grass7:r.neighbors", params_neighbors)
+    with rasterio.open(input_raster_path) as src:
+        profile = src.profile
+        rows_total = src.height
+        cols_total = src.width
+
+    # 出力はタイル化＋DEFLATE(PREDICTOR=2)で書く。高さラスタは大半がゼロ＋
+    # 滑らかな値なので圧縮が強く効き、タイル化により下流のブロック窓読みが可能になる。
+    profile.update(
+        compress="deflate", predictor=2, tiled=True,
+        blockxsize=256, blockysize=256, num_threads="all_cpus"
+    )
+
+    # 入力・フィルタ結果・riskを全面同時に抱えるとメモリが入力の数倍になるため、
+    # kernel_half のハロー付き行ストリップ単位でストリーミング処理する。
+    # ハロー内側の行は全面処理と完全に同じ結果になる（端はmode='nearest'相当）。
+    # H_global_max はストリップ書き出しと同時に走査して求める。
+    tile_h = max(256, 4 * kernel_size)
+    H_global_max = 0.0
+
+    print("[*] 局所最大高さをストリップ単位で計算中"
+          + ("(Numba並列カーネル)..." if HAS_NUMBA else "(scipy maximum_filter)..."))
+    with rasterio.open(input_raster_path) as src, \
+         rasterio.open(localmax_path, "w", **profile) as dst:
+        for y0 in range(0, rows_total, tile_h):
+            y1 = min(y0 + tile_h, rows_total)
+            ry0 = max(0, y0 - kernel_half)
+            ry1 = min(rows_total, y1 + kernel_half)
+            strip = src.read(
+                1, window=rasterio.windows.Window(0, ry0, cols_total, ry1 - ry0)
+            )
+            if HAS_NUMBA:
+                filt = _maxfilt2d(strip, kernel_size)
+            else:
+                filt = maximum_filter(strip, size=kernel_size, mode="nearest")
+            interior = filt[y0 - ry0 : (y0 - ry0) + (y1 - y0)]
+            dst.write(
+                interior, 1, window=rasterio.windows.Window(0, y0, cols_total, y1 - y0)
+            )
+            H_global_max = max(H_global_max, float(interior.max()))
+
+    # COGレイアウトに合わせてオーバービューを付与（localmaxはmax縮約なので
+    # 粗いレベルを読んでも最大値が保存される）
+    with rasterio.open(localmax_path, "r+") as dst:
+        dst.build_overviews([2, 4, 8, 16], Resampling.max)
     print(f"[+] 局所最大高さラスタを作成: {localmax_path}")
 
-    localmax_layer = QgsRasterLayer(localmax_path, f"{layer_name}_localmax")
-    if localmax_layer.isValid():
-        QgsProject.instance().addMapLayer(localmax_layer)
-    else:
-        raise RuntimeError("局所最大高さラスタの読み込みに失敗しました。")
-
 
-    # --------- 3. H_global_max を取得 ---------
-    stats = localmax_layer.dataProvider().bandStatistics(1)
-    H_global_max = stats.maximumValue
+    # --------- 3. H_global_max の確認 ---------
     if H_global_max <= 0:
         raise RuntimeError(f"H_global_max が 0 以下です: {H_global_max}")
     print(f"▶ H_global_max (局所最大高さの最大値) = {H_global_max:.3f} m")
 
 
     # --------- 4. risk_proxy, svf_proxy を 0〜1 で作成 ---------
+    # risk は localmax をブロック窓単位で読み戻しながら実体化する。
+    # svf は「1 - risk」をVRTのPythonピクセル関数として定義し、
+    # Float32ラスタ1枚ぶんの書き出し＋読み戻しを省く（読み出し時に遅延計算）。
     risk_path = os.path.join(output_dir, "risk_proxy_5m.tif")
-    svf_path  = os.path.join(output_dir, "svf_proxy_5m.tif")
-
-    print("[*] GDAL Raster Calculator で risk_proxy = H_local_max / H_global_max を計算中...")
-    expr_risk = f"A/{H_global_max}"
-
-    params_risk = {
-        "INPUT_A": localmax_path,
-        "BAND_A": 1,
-        "INPUT_B": None, "BAND_B": -1,
-        "INPUT_C": None, "BAND_C": -1,
-        "INPUT_D": None, "BAND_D": -1,
-        "INPUT_E": None, "BAND_E": -1,
-        "INPUT_F": None, "BAND_F": -1,
-        "FORMULA": expr_risk,
-        "NO_DATA": 0,
-        "RTYPE": 5,   # Float32
-        "EXTRA": "",
-        "OUTPUT": risk_path
-    }
-    processing.run("gdal:rastercalculator", params_risk)
-    print(f"[+] risk_proxy_5m.tif を作成: {risk_path}")
-
-    print("[*] svf_proxy = 1 - risk_proxy を計算中...")
-    params_svf = {
-        "INPUT_A": risk_path,
-        "BAND_A": 1,
-        "INPUT_B": None, "BAND_B": -1,
-        "INPUT_C": None, "BAND_C": -1,
-        "INPUT_D": None, "BAND_D": -1,
-        "INPUT_E": None, "BAND_E": -1,
-        "INPUT_F": None, "BAND_F": -1,
-        "FORMULA": "1 - A",
-        "NO_DATA": 0,
-        "RTYPE": 5,
-        "EXTRA": "",
-        "OUTPUT": svf_path
-    }
-    processing.run("gdal:rastercalculator", params_svf)
-    print(f"[+] svf_proxy_5m.tif を作成: {svf_path}")
+    svf_path  = os.path.join(output_dir, "svf_proxy_5m.vrt")
+
+    print("[*] risk_proxy = H_local_max / H_global_max を計算中...")
+    H = np.float32(H_global_max)
+    with rasterio.open(localmax_path) as src, \
+         rasterio.open(risk_path, "w", **profile) as dst:
+        for _, window in src.block_windows(1):
+            lm = src.read(1, window=window)
+            if HAS_NUMEXPR:
+                # numexpr は内部でブロック分割して各スレッドがL2に収まる単位で
+                # 評価するため、メモリ帯域律速のこの式に向いている
+                risk_tile = np.empty_like(lm, dtype="float32")
+                ne.evaluate("lm / H", out=risk_tile)
+            else:
+                risk_tile = (lm / H).astype("float32")
+            dst.write(risk_tile, 1, window=window)
+    with rasterio.open(risk_path, "r+") as dst:
+        dst.build_overviews([2, 4, 8, 16], Resampling.average)
+    print(f"[+] 作成: {risk_path}")
+
+    print("[*] svf_proxy = 1 - risk_proxy をVRTピクセル関数として定義中...")
+    os.environ["GDAL_VRT_ENABLE_PYTHON"] = "YES"
+    gt = profile["transform"].to_gdal()
+    svf_vrt = f"""<VRTDataset rasterXSize="{profile['width']}" rasterYSize="{profile['height']}">
+  <SRS>EPSG:6677</SRS>
+  <GeoTransform>{', '.join(repr(v) for v in gt)}</GeoTransform>
+  <VRTRasterBand dataType="Float32" band="1" subClass="VRTDerivedRasterBand">
+    <PixelFunctionType>svf_fn</PixelFunctionType>
+    <PixelFunctionLanguage>Python</PixelFunctionLanguage>
+    <PixelFunctionCode><![CDATA[
+def svf_fn(in_ar, out_ar, xoff, yoff, xsize, ysize, raster_xsize, raster_ysize, buf_radius, gt, **kwargs):
+    out_ar[:] = 1.0 - in_ar[0] / {H_global_max!r}
+]]></PixelFunctionCode>
+    <SimpleSource>
+      <SourceFilename relativeToVRT="1">{os.path.basename(localmax_path)}</SourceFilename>
+      <SourceBand>1</SourceBand>
+    </SimpleSource>
+  </VRTRasterBand>
+</VRTDataset>
+"""
+    with open(svf_path, "w", encoding="utf-8") as f:
+        f.write(svf_vrt)
+    print(f"[+] 作成: {svf_path}")
 
 
     # --------- 5. 結果レイヤを追加 ---------
-    risk_layer = QgsRasterLayer(risk_path, "risk_proxy_5m")
-    svf_layer  = QgsRasterLayer(svf_path,  "svf_proxy_5m")
-
-    for lyr in (risk_layer, svf_layer):
+    # 検証とプロジェクト追加は末尾で一括して行う（各GeoTIFFのOpenは1回で済む）
+    outputs = [
+        (localmax_path, f"{layer_name}_localmax"),
+        (risk_path, "risk_proxy_5m"),
+        (svf_path, "svf_proxy_5m"),
+    ]
+    for path, name in outputs:
+        lyr = QgsRasterLayer(path, name)
         if lyr.isValid():
             QgsProject.instance().addMapLayer(lyr)
         else:
-            print(f"⚠ レイヤの読み込みに失敗: {lyr.name()}")
+            print(f"⚠ レイヤの読み込みに失敗: {name}")
 
     print("=========== SKYVIEW PROXY VIA NEIGHBOR MAX DONE ===========")
 
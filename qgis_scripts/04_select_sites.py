@@ -27,20 +27,24 @@ def generate_empty_sites_layer(output_dir):
     proj = QgsProject.instance()
 
     # 1) もし同じgpkgを参照しているレイヤがあれば全部外す（ロック回避）
-    to_remove = []
-    for lyr in proj.mapLayers().values():
+    # 部分一致(in)だと同じ語幹の別ファイルまで誤って外しうるため、
+    # データソースのパス部を正規化して完全一致で比較する
+    target = os.path.normcase(os.path.abspath(gpkg_path))
+
+    def _source_path(lyr):
         try:
-            src = lyr.source()
-        except:
-            continue
-        # パスが含まれているか判定
-        if gpkg_path in src:
-            to_remove.append(lyr.id())
+            return os.path.normcase(os.path.abspath(lyr.source().split("|")[0]))
+        except Exception:
+            return None
 
-    for lid in to_remove:
-        proj.removeMapLayer(lid)
+    to_remove = [
+        lid for lid, lyr in proj.mapLayers().items()
+        if _source_path(lyr) == target
+    ]
 
     if to_remove:
+        # removeMapLayers はC++側で一括処理される（レイヤごとの呼び出し不要）
+        proj.removeMapLayers(to_remove)
         print(f"[OK] removed {len(to_remove)} layer(s) that referenced the gpkg")
 
     # 2) 既存gpkgを削除（更新モードで開けない問題を回避）
@@ -1,8 +1,42 @@
 import os
-import math
-import processing
+import sys
+import numpy as np
+from osgeo import gdal
 from qgis.core import QgsProject, QgsRasterLayer
 
+# QGISコンソール実行時でも同階層の pipeline_utils を見つけられるようにする
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline_utils import load_or_compute_risk_quantiles
+
+# Numbaがあれば並列JIT版の分類カーネルを使う（無ければnp.digitizeにフォールバック）
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True)
+    def _classify_tile(inp, q30, q70, nodata, out):
+        """Float32タイル→uint8クラス（0=NoData, 1=低, 2=中, 3=高）を1パスで書く。
+
+        比較2回＋書き込み1回/画素のSIMDループ。一時配列を作らないので
+        メモリ帯域律速（5バイト/画素）で動く。nodataにNaNを渡すと
+        v==nodata が常に偽になり、NaN判定(v!=v)だけが効く。
+        """
+        for i in prange(inp.shape[0]):
+            for j in range(inp.shape[1]):
+                v = inp[i, j]
+                if v != v or v == nodata:
+                    out[i, j] = 0
+                elif v < q30:
+                    out[i, j] = 1
+                elif v < q70:
+                    out[i, j] = 2
+                else:
+                    out[i, j] = 3
+
 def classify_risk_based_on_quantiles(output_dir, input_raster_path):
     """
     指定されたリスク指標ラスタ(risk_proxy)の分位点(30%, 70%)を計算し、
@@ -22,86 +56,79 @@ def classify_risk_based_on_quantiles(output_dir, input_raster_path):
     if not os.path.exists(input_raster_path):
         raise FileNotFoundError(f"入力ファイルが見つかりません: {input_raster_path}")
 
-    layer_name = os.path.basename(input_raster_path)
-    risk_layer = QgsRasterLayer(input_raster_path, layer_name)
-
-    if not risk_layer.isValid():
+    ds = gdal.Open(input_raster_path)
+    if ds is None:
         raise RuntimeError(f"入力ラスタのロードに失敗しました: {input_raster_path}")
 
     print("▶ INPUT:", input_raster_path)
-    print("▶ CRS:", risk_layer.crs().authid())
-    print("▶ Size:", risk_layer.width(), "x", risk_layer.height())
-
-    # ==== 2. 値を全て読み取り、ECDF（分位点）を計算 ====
-    provider = risk_layer.dataProvider()
-    extent = risk_layer.extent()
-    cols = risk_layer.width()
-    rows = risk_layer.height()
-
-    block = provider.block(1, extent, cols, rows)
-    nodata = provider.sourceNoDataValue(1)
-
-    values = []
-    for r in range(block.height()):
-        for c in range(block.width()):
-            v = block.value(c, r)
-            if v is None:
-                continue
-            if nodata is not None and v == nodata:
-                continue
-            if isinstance(v, float) and math.isnan(v):
-                continue
-            values.append(float(v))
-
-    values.sort()
-    n = len(values)
-    if n == 0:
-        raise RuntimeError("有効ピクセルが0です（入力がNoDataのみの可能性）。AOIマスク/入力レイヤを確認してください。")
-
-    # 分位点計算ロジック (既存維持)
-    def quantile(p):
-        i = (n - 1) * p
-        lo = math.floor(i)
-        hi = math.ceil(i)
-        if lo == hi:
-            return values[int(i)]
-        return values[lo] * (hi - i) + values[hi] * (i - lo)
-
-    q30 = quantile(0.30)
-    q70 = quantile(0.70)
-
-    print("n:", n)
-    print("min:", min(values), "max:", max(values))
+    print("▶ Size:", ds.RasterXSize, "x", ds.RasterYSize)
+
+    # ==== 2. 分位点の取得（キャッシュ経由） ====
+    # 03が直前に同じラスタの分位点を計算済みなら、そのサイドカーを読むだけで
+    # 済む（値のフルスキャンを丸ごと省略）。無ければここで計算＆保存される。
+    res = load_or_compute_risk_quantiles(input_raster_path)
+    q30, _, q70 = res["q"]
+
+    print("n:", res["n"])
+    print("min:", res["vmin"], "max:", res["vmax"])
     print("q30:", q30, "q70:", q70)
 
-    # ==== 3. 分類式（Raster Calculator） ====
+    # ==== 3-4. 分類とストリーミング書き出し ====
     # クラス1: < q30 (低リスク)
     # クラス2: >= q30 AND < q70 (中リスク)
     # クラス3: >= q70 (高リスク)
-    expr = f"(A < {q30})*1 + ((A >= {q30})*(A < {q70}))*2 + (A >= {q70})*3"
-    print("▶ Expression:", expr)
-
-    params = {
-        "INPUT_A": input_raster_path,
-        "BAND_A": 1,
-        "INPUT_B": None, "BAND_B": -1,
-        "INPUT_C": None, "BAND_C": -1,
-        "INPUT_D": None, "BAND_D": -1,
-        "INPUT_E": None, "BAND_E": -1,
-        "INPUT_F": None, "BAND_F": -1,
-        "FORMULA": expr,
-        "NO_DATA": 0,
-        "RTYPE": 5,    # Float32
-        "EXTRA": "",
-        "OUTPUT": out_path
-    }
-
-    print("[*] running gdal:rastercalculator ...")
-    processing.run("gdal:rastercalculator", params)
+    # 全面を一度にメモリへ載せず、行ストリップ単位で読み→分類→書きを
+    # ストリーミングする。Numbaがあれば比較2回/画素のJITカーネル、
+    # 無ければ np.digitize（同じ境界規則）で分類する。クラス値は{0..3}なので
+    # Float32ではなくByte(uint8)で保持する（NoData=0）。
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+
+    driver = gdal.GetDriverByName("GTiff")
+    # タイル化＋DEFLATEで書く（クラス値ラスタは圧縮が強く効き、
+    # 下流のブロック窓読みにも揃う）
+    out_ds = driver.Create(
+        out_path, cols, rows, 1, gdal.GDT_Byte,
+        options=["TILED=YES", "BLOCKXSIZE=256", "BLOCKYSIZE=256",
+                 "COMPRESS=DEFLATE", "PREDICTOR=2"]
+    )
+    out_ds.SetGeoTransform(ds.GetGeoTransform())
+    out_ds.SetProjection(ds.GetProjection())
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetNoDataValue(0)
+
+    print("[*] ストリップ単位で分類中"
+          + ("(Numba並列カーネル)..." if HAS_NUMBA else "(np.digitize)..."))
+    # nodata未定義ならNaNを渡す（v==nodata が常に偽になり、NaN判定のみ効く）。
+    # しきい値はfloat64のまま渡す（float32に丸めるとdigitize経路と境界画素で
+    # 分類がずれうる。カーネル内の比較はfloat64に昇格して行われる）。
+    nd = float(nodata) if nodata is not None else float("nan")
+    strip_h = 256
+    for y in range(0, rows, strip_h):
+        h = min(strip_h, rows - y)
+        tile = band.ReadAsArray(0, y, cols, h)
+        if HAS_NUMBA:
+            cls_tile = np.empty(tile.shape, dtype=np.uint8)
+            _classify_tile(tile, float(q30), float(q70), nd, cls_tile)
+        else:
+            tile_valid = np.isfinite(tile)
+            if nodata is not None:
+                tile_valid &= (tile != nodata)
+            cls_tile = np.where(
+                tile_valid,
+                (np.digitize(tile, [q30, q70]) + 1).astype(np.uint8),
+                np.uint8(0),
+            )
+        out_band.WriteArray(cls_tile, 0, y)
+
+    out_band.FlushCache()
+    # クラス値なのでオーバービューは最近傍で作る（平均では混色する）
+    out_ds.BuildOverviews("NEAREST", [2, 4, 8, 16])
+    out_ds = None
 
     print("[+] created:", out_path)
-    
-    # ==== 4. 結果レイヤの追加 ====
+
     out_lyr = QgsRasterLayer(out_path, "risk_class_5m_py")
     if out_lyr.isValid():
         QgsProject.instance().addMapLayer(out_lyr)
@@ -115,13 +142,12 @@ def classify_risk_based_on_quantiles(output_dir, input_raster_path):
 if __name__ == "__main__":
     # ファイル配置場所: qgis_scripts/ (Rootから1階層深い)
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    
+
     # data/processed へのパス (../data/processed)
     processed_dir = os.path.join(base_dir, "..", "data", "processed")
-    
+
     # 入力ファイルパス (前工程の出力と想定)
     input_tif = os.path.join(processed_dir, "risk_proxy_5m.tif")
-    
+
     # 関数実行
     classify_risk_based_on_quantiles(processed_dir, input_tif)
-
@@ -1,6 +1,8 @@
 import os
 import processing
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal
 from qgis.core import (
     QgsVectorLayer,
     QgsRasterLayer,
@@ -24,6 +26,52 @@ def calculate_aoi_statistics(base_dir, raster_filename="risk_class_5m_py.tif", a
     if not os.path.exists(processed_dir):
         raise FileNotFoundError(f"ディレクトリが見つかりません: {processed_dir}")
 
+    # ----------------------------------------------------
+    # 0. ラスタ集計をバックグラウンドで開始
+    # ----------------------------------------------------
+    # GDALのストリップ集計は純粋なI/O＋NumPyなので別スレッドで走らせ、
+    # その間に主スレッドでQGISのAOI再投影・面積計算を進める
+    # （QGISのprocessing呼び出しは主スレッドに置いたまま）。
+    if not os.path.exists(raster_path):
+        raise FileNotFoundError(f"集計対象のラスタが見つかりません: {raster_path}")
+
+    def _count_classes():
+        ds = gdal.Open(raster_path)
+        if ds is None:
+            raise RuntimeError("ラスタの読み込みに失敗しました。")
+
+        gt = ds.GetGeoTransform()
+        band = ds.GetRasterBand(1)
+        no_data_val = band.GetNoDataValue()
+        cols = ds.RasterXSize
+        rows = ds.RasterYSize
+        strip_h = max(band.GetBlockSize()[1], 256)
+
+        cnt = np.zeros(4, dtype=np.int64)
+        for y in range(0, rows, strip_h):
+            h = min(strip_h, rows - y)
+            flat = band.ReadAsArray(0, y, cols, h).ravel()
+            # Float系で来た場合のみNaNを落としてint化（Byteならそのまま）
+            if flat.dtype.kind == "f":
+                flat = flat[np.isfinite(flat)].astype(np.int64)
+            c = np.bincount(flat, minlength=cnt.size)
+            if c.size > cnt.size:
+                c[: cnt.size] += cnt
+                cnt = c
+            else:
+                cnt += c
+
+        # NoData と 0（背景）は無効値として除外（必要に応じて変更可）
+        if no_data_val is not None and float(no_data_val).is_integer():
+            nd_idx = int(no_data_val)
+            if 0 <= nd_idx < cnt.size:
+                cnt[nd_idx] = 0
+        cnt[0] = 0
+        return cnt, abs(gt[1]), abs(gt[5])
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    count_future = pool.submit(_count_classes)
+
     # ----------------------------------------------------
     # 1. AOIレイヤの取得と面積計算 (EPSG:6677)
     # ----------------------------------------------------
@@ -46,69 +94,30 @@ def calculate_aoi_statistics(base_dir, raster_filename="risk_class_5m_py.tif", a
     result = processing.run("native:reprojectlayer", params_reproj)
     aoi_reproj = result["OUTPUT"]
     
-    # 全フィーチャの面積合計を算出
-    total_aoi_area_m2 = 0.0
-    for feature in aoi_reproj.getFeatures():
-        if feature.hasGeometry():
-            total_aoi_area_m2 += feature.geometry().area()
-            
+    # 全フィーチャの面積合計を算出（ジェネレータでC実装のsumに渡す）
+    total_aoi_area_m2 = sum(
+        f.geometry().area() for f in aoi_reproj.getFeatures() if f.hasGeometry()
+    )
+
     print(f"▶ AOI 総面積: {total_aoi_area_m2:,.2f} m²")
 
     # ----------------------------------------------------
-    # 2. ラスタデータの読み込みと集計
+    # 2. ラスタ集計結果の回収
     # ----------------------------------------------------
-    if not os.path.exists(raster_path):
-        raise FileNotFoundError(f"集計対象のラスタが見つかりません: {raster_path}")
-
-    print(f"[*] ラスタを集計中: {raster_path}")
-    raster_layer = QgsRasterLayer(raster_path, "target_raster")
-    
-    if not raster_layer.isValid():
-        raise RuntimeError("ラスタの読み込みに失敗しました。")
+    print(f"[*] ラスタ集計の完了を待機中: {raster_path}")
+    cnt, pixel_size_x, pixel_size_y = count_future.result()
+    pool.shutdown()
 
-    # ピクセルサイズ取得 (m)
-    pixel_size_x = raster_layer.rasterUnitsPerPixelX()
-    pixel_size_y = raster_layer.rasterUnitsPerPixelY()
     area_per_pixel = pixel_size_x * pixel_size_y
     print(f"▶ ピクセルサイズ: {pixel_size_x:.2f}m x {pixel_size_y:.2f}m (1px = {area_per_pixel:.2f} m²)")
 
-    # ラスタの値を取得してカウント
-    provider = raster_layer.dataProvider()
-    extent = raster_layer.extent()
-    cols = raster_layer.width()
-    rows = raster_layer.height()
-    
-    # ブロック全体を取得
-    block = provider.block(1, extent, cols, rows)
-    no_data_val = provider.sourceNoDataValue(1)
-    
-    # バイナリデータとして取得し、Numpy配列化して高速集計
-    # ※ データ型に応じて読み方が変わるが、ここではFloat32/Int等を想定して汎用的に処理
-    raw_data = []
-    for r in range(rows):
-        for c in range(cols):
-            val = block.value(c, r)
-            # NoData判定
-            if no_data_val is not None and val == no_data_val:
-                continue
-            # NaN判定
-            if isinstance(val, float) and np.isnan(val):
-                continue
-            # 0も無効値(背景)として扱う場合が多いので除外（必要に応じて変更可）
-            if val == 0:
-                continue
-                
-            raw_data.append(int(val)) # クラスIDなのでint化
-
-    # 集計実行
-    if not raw_data:
+    stats = {int(cls_id): int(n) for cls_id, n in enumerate(cnt) if n > 0}
+
+    if not stats:
         print("⚠ 有効なピクセルが1つもありませんでした。")
         return
 
-    unique_classes, counts = np.unique(raw_data, return_counts=True)
-    stats = dict(zip(unique_classes, counts))
-    
-    total_valid_pixels = sum(counts)
+    total_valid_pixels = sum(stats.values())
     total_valid_area_m2 = total_valid_pixels * area_per_pixel
 
     # ----------------------------------------------------
@@ -0,0 +1,84 @@
+"""qgis_scripts 間で共有する小さなユーティリティ。
+
+03（分位点分析）と 05（分類）は back-to-back で実行され、どちらも同じ
+risk_proxy ラスタの同じ画素集合に対して分位点を計算していた。ここに
+読み込み＋分位点計算を集約し、結果をサイドカー（<raster>.quantiles.npz）に
+キャッシュすることで、2本目のフルスキャンと分位点計算を丸ごと省く。
+"""
+import os
+import numpy as np
+from osgeo import gdal
+
+# パイプラインで使う分位点（30/50/70%）。03は3点すべて、05は両端2点を使う。
+QUANTILE_PROBS = (0.30, 0.50, 0.70)
+
+
+def quantiles_via_partition(vals, probs):
+    """複数分位点を1回の np.partition でまとめて求める（線形補間＝np.quantileと同値）。
+
+    np.quantile は要求された分位点ごとに内部でpartitionをやり直すため、
+    固定の数点だけなら必要な順位位置を一括で渡す方が速い。O(n)・追加ソート不要。
+    """
+    n = vals.size
+    ks = np.array([(n - 1) * p for p in probs])
+    lo = ks.astype(np.int64)
+    hi = np.minimum(lo + 1, n - 1)
+    part = np.partition(vals, np.unique(np.concatenate([lo, hi])))
+    frac = ks - lo
+    return part[lo] + (part[hi] - part[lo]) * frac
+
+
+def stream_valid_values(raster_path):
+    """有効画素（有限かつ非NoData）のみを行ストリップ単位で読み集めてfloat32で返す。
+
+    全面一括読みと違い、ピークメモリは1ストリップ＋有効値で済む。
+    """
+    ds = gdal.Open(raster_path)
+    if ds is None:
+        raise RuntimeError(f"ラスタのロードに失敗しました: {raster_path}")
+
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    cols, rows = ds.RasterXSize, ds.RasterYSize
+    strip_h = max(band.GetBlockSize()[1], 256)
+
+    chunks = []
+    for y in range(0, rows, strip_h):
+        h = min(strip_h, rows - y)
+        a = band.ReadAsArray(0, y, cols, h)
+        mask = np.isfinite(a)
+        if nodata is not None:
+            mask &= (a != nodata)
+        if mask.any():
+            chunks.append(a[mask].astype(np.float32, copy=False))
+
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.float32)
+
+
+def load_or_compute_risk_quantiles(raster_path, probs=QUANTILE_PROBS):
+    """分位点をキャッシュ付きで返す。
+
+    サイドカーが入力より新しく、同じ分位点集合を持つならそれを読む（O(1)）。
+    無ければストリーミング読み＋partitionで計算し、サイドカーに保存する。
+    戻り値: {"q": ndarray(probsに対応), "n": int, "vmin": float, "vmax": float}
+    """
+    cache_path = raster_path + ".quantiles.npz"
+    if (os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(raster_path)):
+        z = np.load(cache_path)
+        if z["probs"].shape == (len(probs),) and np.allclose(z["probs"], probs):
+            print(f"[*] 分位点キャッシュを再利用: {cache_path}")
+            return {"q": z["q"], "n": int(z["n"]),
+                    "vmin": float(z["stats"][0]), "vmax": float(z["stats"][1])}
+
+    vals = stream_valid_values(raster_path)
+    if vals.size == 0:
+        raise RuntimeError("値が1つも取れませんでした。有効なデータがあるか確認してください。")
+
+    q = quantiles_via_partition(vals, probs)
+    stats = np.array([vals.min(), vals.max()], dtype=np.float64)
+    np.savez(cache_path, probs=np.asarray(probs, dtype=np.float64),
+             q=q, n=vals.size, stats=stats)
+    print(f"[+] 分位点キャッシュを保存: {cache_path}")
+    return {"q": q, "n": int(vals.size),
+            "vmin": float(stats[0]), "vmax": float(stats[1])}
@@ -1,5 +1,6 @@
 import os
 import csv
+import mmap
 import argparse
 
 # ================= CONSTANTS =================
@@ -56,20 +57,23 @@ RAW_COLS_36 = [
     "Col28", "Col29", "Col30", "Col31", "Col32", "Col33", "Col34", "Col35"
 ]
 
+# ヘッダー行を示す2列目トークン（レコード種別ごと、モジュールロード時に1回構築）
+HEADER_TOKENS = {
+    "Fix": frozenset(("Provider", "Latitude", "Longitude", "UnixTimeMillis", "TimeNanos")),
+    "Status": frozenset(("UnixTimeMillis", "TimeNanos", "Svid", "Cn0DbHz", "ElevationDegrees", "UsedInFix")),
+    "Raw": frozenset(("TimeNanos", "FullBiasNanos", "Svid", "Cn0DbHz")),
+}
+
 def count_cols(line: str) -> int:
     return len(next(csv.reader([line])))
 
 def has_header(lines, rec_type: str) -> bool:
-    parsed = [next(csv.reader([ln])) for ln in lines]
-    for row in parsed:
-        if len(row) < 2:
-            continue
-        second = (row[1] or "").strip()
-        if rec_type == "Fix" and second in ("Provider", "Latitude", "Longitude", "UnixTimeMillis", "TimeNanos"):
-            return True
-        if rec_type == "Status" and second in ("UnixTimeMillis", "TimeNanos", "Svid", "Cn0DbHz", "ElevationDegrees", "UsedInFix"):
-            return True
-        if rec_type == "Raw" and second in ("TimeNanos", "FullBiasNanos", "Svid", "Cn0DbHz"):
+    # 行ごとにcsv.readerを立てるのは2列目を覗くだけには重い。
+    # split(',', 2) で2区切りだけ行い、frozensetで種別分岐なしに判定する。
+    tokens = HEADER_TOKENS[rec_type]
+    for ln in lines:
+        parts = ln.split(",", 2)
+        if len(parts) >= 2 and parts[1].strip() in tokens:
             return True
     return False
 
@@ -88,8 +92,11 @@ def normalize_gnss_headers(in_dir, out_dir, no_raw_header=False):
     if not os.path.exists(in_dir):
         raise FileNotFoundError(f"入力ディレクトリが見つかりません: {in_dir}")
 
-    files = [f for f in os.listdir(in_dir) if f.lower().endswith(".txt")]
-    files.sort()
+    # scandirはd_typeをキャッシュしたDirEntryを返すため、エントリごとの
+    # 追加statなしでファイル判定できる（ネットワークFSで効く）
+    with os.scandir(in_dir) as it:
+        files = sorted(e.name for e in it
+                       if e.is_file() and e.name.lower().endswith(".txt"))
 
     if not files:
         print(f"[!] {in_dir} に .txt ファイルが見つかりません。")
@@ -99,62 +106,77 @@ def normalize_gnss_headers(in_dir, out_dir, no_raw_header=False):
         src_path = os.path.join(in_dir, fname)
         dst_path = os.path.join(out_dir, fname)
 
-        # ファイル読み込み
-        with open(src_path, "r", encoding="utf-8", errors="ignore") as f:
-            lines = f.read().splitlines()
-
-        fix_lines = [ln for ln in lines if ln.startswith(FIX_PREFIX)]
-        status_lines = [ln for ln in lines if ln.startswith(STATUS_PREFIX)]
-        raw_lines = [ln for ln in lines if ln.startswith(RAW_PREFIX)]
+        # 空ファイルはmmapできないのでそのまま空で出力
+        if os.path.getsize(src_path) == 0:
+            open(dst_path, "wb").close()
+            print(f"[OK] Normalized: {fname}")
+            continue
 
-        need_fix_header = bool(fix_lines) and (not has_header(fix_lines[:200], "Fix"))
-        need_status_header = bool(status_lines) and (not has_header(status_lines[:200], "Status"))
-        need_raw_header = (not no_raw_header) and bool(raw_lines) and (not has_header(raw_lines[:200], "Raw"))
+        # ファイル全体を str にデコード→splitlines でリスト化する二重コピーを
+        # やめ、読み取り専用でmmapしバイト行のまま走査する。デコードするのは
+        # ヘッダー判定・列数チェックに使うサンプル行（種別ごと先頭200行）だけ。
+        f_src = open(src_path, "rb")
+        mm = mmap.mmap(f_src.fileno(), 0, access=mmap.ACCESS_READ)
+
+        samples = {FIX_PREFIX: [], STATUS_PREFIX: [], RAW_PREFIX: []}
+        prefix_by_byte = {b"F": (FIX_PREFIX, b"Fix,"),
+                          b"S": (STATUS_PREFIX, b"Status,"),
+                          b"R": (RAW_PREFIX, b"Raw,")}
+        for ln in iter(mm.readline, b""):
+            entry = prefix_by_byte.get(ln[:1])
+            if entry is not None and ln.startswith(entry[1]):
+                sample = samples[entry[0]]
+                if len(sample) < 200:
+                    sample.append(ln.decode("utf-8", errors="ignore").rstrip("\r\n"))
+
+        fix_sample = samples[FIX_PREFIX]
+        status_sample = samples[STATUS_PREFIX]
+        raw_sample = samples[RAW_PREFIX]
+
+        need_fix_header = bool(fix_sample) and (not has_header(fix_sample, "Fix"))
+        need_status_header = bool(status_sample) and (not has_header(status_sample, "Status"))
+        need_raw_header = (not no_raw_header) and bool(raw_sample) and (not has_header(raw_sample, "Raw"))
 
         # Sanity check
         if need_fix_header:
-            n = count_cols(fix_lines[0])
+            n = count_cols(fix_sample[0])
             if n != len(FIX_COLS_17):
                 raise RuntimeError(f"{fname}: Fix cols={n} but expected {len(FIX_COLS_17)}.")
         if need_status_header:
-            n = count_cols(status_lines[0])
+            n = count_cols(status_sample[0])
             if n != len(STATUS_COLS_14):
                 raise RuntimeError(f"{fname}: Status cols={n} but expected {len(STATUS_COLS_14)}.")
         if need_raw_header:
-            n = count_cols(raw_lines[0])
+            n = count_cols(raw_sample[0])
             if n != len(RAW_COLS_36):
                 raise RuntimeError(f"{fname}: Raw cols={n} but expected {len(RAW_COLS_36)}.")
 
-        seen_fix = False
-        seen_status = False
-        seen_raw = False
-
-        out_lines = []
-        for ln in lines:
-            # Header insertion
-            if (not seen_fix) and need_fix_header and ln.startswith(FIX_PREFIX):
-                out_lines.append(",".join(FIX_COLS_17))
-                seen_fix = True
-            if (not seen_status) and need_status_header and ln.startswith(STATUS_PREFIX):
-                out_lines.append(",".join(STATUS_COLS_14))
-                seen_status = True
-            if (not seen_raw) and need_raw_header and ln.startswith(RAW_PREFIX):
-                out_lines.append(",".join(RAW_COLS_36))
-                seen_raw = True
-
-            out_lines.append(ln)
-
-            # Mark as seen
-            if (not seen_fix) and ln.startswith(FIX_PREFIX):
-                seen_fix = True
-            if (not seen_status) and ln.startswith(STATUS_PREFIX):
-                seen_status = True
-            if (not seen_raw) and ln.startswith(RAW_PREFIX):
-                seen_raw = True
-
-        with open(dst_path, "w", encoding="utf-8") as f:
-            f.write("\n".join(out_lines) + "\n")
-        
+        # 挿入待ちヘッダーを先頭1バイトで引けるようにしておき、各行あたりの
+        # 判定を最大6回のstartswithから辞書引き1回＋startswith1回に減らす。
+        # 出力はバイト行のままバッファ付きで書き、行リストの再構築をしない。
+        pending_headers = {}
+        if need_fix_header:
+            pending_headers[b"F"] = (b"Fix,", (",".join(FIX_COLS_17) + "\n").encode("utf-8"))
+        if need_status_header:
+            pending_headers[b"S"] = (b"Status,", (",".join(STATUS_COLS_14) + "\n").encode("utf-8"))
+        if need_raw_header:
+            pending_headers[b"R"] = (b"Raw,", (",".join(RAW_COLS_36) + "\n").encode("utf-8"))
+
+        mm.seek(0)
+        ln = b""
+        with open(dst_path, "wb") as f_out:
+            for ln in iter(mm.readline, b""):
+                entry = pending_headers.get(ln[:1]) if pending_headers else None
+                if entry is not None and ln.startswith(entry[0]):
+                    f_out.write(entry[1])
+                    del pending_headers[ln[:1]]
+                f_out.write(ln)
+            if ln and not ln.endswith(b"\n"):
+                f_out.write(b"\n")
+
+        mm.close()
+        f_src.close()
+
         print(f"[OK] Normalized: {fname}")
 
     print("=========== GNSS HEADER NORMALIZATION DONE ===========")
@@ -1,9 +1,15 @@
+import functools
+import io
 import os
 import glob
+import multiprocessing
 import shutil
 import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # GUIバックエンド探索を省く（ヘッドレス環境でも安定）
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import warnings
 
@@ -15,66 +21,199 @@ except ImportError:
     print("Error: Library missing. Run: pip install pyproj scikit-learn pandas numpy matplotlib")
     exit(1)
 
+# Numbaがあれば全エポックのHDOPをまとめて計算するJITカーネルを使う
+# （無ければ従来のgroupbyループにフォールバック）
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _hdop_per_epoch(az_rad, el_rad, offsets, out):
+        """エポック境界offsets（長さK+1）で区切られた衛星配列からHDOPをK個まとめて計算する。
+
+        エポックごとのPython→NumPy往復（G行列の生成・転置・積）を1回の
+        コンパイル済みループに融合する。正規行列 G^T G は対称正定値なので
+        上三角のみ累積し、LAPACKを呼ばず4x4コレスキー分解＋前進代入の
+        閉形式で Q[0,0]+Q[1,1] だけを求める（LLVMが完全展開できるサイズ）。
+        分解が立たない＝幾何が退化したエポックはNaN。
+        """
+        for k in prange(offsets.shape[0] - 1):
+            s, e = offsets[k], offsets[k + 1]
+            if e - s < 4:
+                out[k] = np.nan
+                continue
+            ata = np.zeros((4, 4))
+            for i in range(s, e):
+                ce = np.cos(el_rad[i])
+                g0 = -ce * np.sin(az_rad[i])
+                g1 = -ce * np.cos(az_rad[i])
+                g2 = -np.sin(el_rad[i])
+                ata[0, 0] += g0 * g0
+                ata[0, 1] += g0 * g1
+                ata[0, 2] += g0 * g2
+                ata[0, 3] += g0
+                ata[1, 1] += g1 * g1
+                ata[1, 2] += g1 * g2
+                ata[1, 3] += g1
+                ata[2, 2] += g2 * g2
+                ata[2, 3] += g2
+                ata[3, 3] += 1.0
+            # コレスキー分解 ata = L L^T（上三角参照のみでよい）
+            ok = True
+            ell = np.zeros((4, 4))
+            for c in range(4):
+                s = ata[c, c]
+                for m in range(c):
+                    s -= ell[c, m] * ell[c, m]
+                if s <= 1e-12:
+                    ok = False
+                    break
+                ell[c, c] = np.sqrt(s)
+                for r in range(c + 1, 4):
+                    s2 = ata[c, r]
+                    for m in range(c):
+                        s2 -= ell[r, m] * ell[c, m]
+                    ell[r, c] = s2 / ell[c, c]
+            if not ok:
+                out[k] = np.nan
+            else:
+                # Q = A^-1 = L^-T L^-1 なので Q[j,j] = ||L^-1 e_j||^2。
+                # 必要な対角2成分だけ前進代入で解く
+                q_sum = 0.0
+                for j in range(2):
+                    x = np.zeros(4)
+                    for i in range(j, 4):
+                        s3 = 1.0 if i == j else 0.0
+                        for m in range(i):
+                            s3 -= ell[i, m] * x[m]
+                        x[i] = s3 / ell[i, i]
+                    for i in range(4):
+                        q_sum += x[i] * x[i]
+                out[k] = np.sqrt(q_sum)
+
+    # 初回のJITコンパイル（数秒かかりうる）をインポート時に済ませる。
+    # cache=True なので2回目以降の起動はディスクキャッシュの復元だけになる。
+    _hdop_per_epoch(np.zeros(4), np.zeros(4),
+                    np.array([0, 4], dtype=np.int64), np.empty(1))
+
 # ==========================================
 # ユーティリティ関数 (GNSS Parser)
 # ==========================================
+# Cパーサのトークン化と同時に数値化させるための型マップ。
+# UnixTimeMillisは欠損(NaN)を表現できるようfloat64で読む。
+FIX_DTYPES = {
+    'UnixTimeMillis': 'float64', 'LatitudeDegrees': 'float64',
+    'LongitudeDegrees': 'float64', 'AccuracyMeters': 'float32',
+}
+STATUS_DTYPES = {
+    'UnixTimeMillis': 'float64', 'Cn0DbHz': 'float32',
+    'ElevationDegrees': 'float32', 'AzimuthDegrees': 'float32',
+    'UsedInFix': 'float32',
+}
+
+def _read_records(buf, names, dtypes):
+    """種別ごとの行バッファをCパーサで読み、既知列は読みながら型付けする。
+
+    型に合わない値が混ざったログでは dtype 指定がValueErrorになるため、
+    その場合のみ型指定なしで読み直す（残った列は呼び出し側がcoerceする）。
+    """
+    dtype = {c: t for c, t in dtypes.items() if c in names}
+    try:
+        return pd.read_csv(buf, header=None, names=names, engine='c',
+                           on_bad_lines='skip', dtype=dtype)
+    except ValueError:
+        buf.seek(0)
+        return pd.read_csv(buf, header=None, names=names, engine='c',
+                           on_bad_lines='skip')
+
 def parse_gnss_log(filepath):
-    fix_lines, status_lines = [], []
+    # 行をPythonのリスト(リストのリスト)に溜めてDataFrame化すると、
+    # リスト→DataFrame→to_numericの三重コピーになる。行を種別ごとの
+    # バッファに振り分けるだけにして、トークン化と型付けはpandasの
+    # Cパーサに一括で任せる（1パス・列指向バッファ1つ）。
     fix_header, status_header = None, None
+    fix_buf, status_buf = io.StringIO(), io.StringIO()
     try:
         with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
             for line in f:
-                line = line.strip()
-                if line.startswith('# Fix'):
+                if line.startswith('Fix'):
+                    fix_buf.write(line)
+                elif line.startswith('Status'):
+                    status_buf.write(line)
+                elif line.startswith('# Fix'):
                     fix_header = line.replace('#', '').strip().split(',')
                 elif line.startswith('# Status'):
                     status_header = line.replace('#', '').strip().split(',')
-                elif line.startswith('Fix'):
-                    fix_lines.append(line.split(','))
-                elif line.startswith('Status'):
-                    status_lines.append(line.split(','))
-                    
+
         if not fix_header or not status_header:
             return None, None, "Missing Header"
-            
-        df_fix = pd.DataFrame(fix_lines, columns=fix_header)
-        df_status = pd.DataFrame(status_lines, columns=status_header)
-        
-        # 数値変換
+
+        fix_buf.seek(0)
+        status_buf.seek(0)
+        df_fix = _read_records(fix_buf, fix_header, FIX_DTYPES)
+        df_status = _read_records(status_buf, status_header, STATUS_DTYPES)
+
+        # 数値変換（Cパーサが既に数値化していれば何もしない。混在などで
+        # object型のまま残った列だけ従来どおり coerce する）
         for df, cols in [
             (df_fix, ['UnixTimeMillis', 'LatitudeDegrees', 'LongitudeDegrees', 'AccuracyMeters']),
             (df_status, ['UnixTimeMillis', 'Cn0DbHz', 'ElevationDegrees', 'AzimuthDegrees', 'UsedInFix'])
         ]:
             for c in cols:
-                if c in df.columns:
+                if c in df.columns and not pd.api.types.is_numeric_dtype(df[c]):
                     df[c] = pd.to_numeric(df[c], errors='coerce')
-        
+
         return df_fix, df_status, "OK"
     except Exception as e:
         return None, None, str(e)
 
+@functools.lru_cache(maxsize=None)
+def get_transformer(src_epsg, dst_epsg):
+    # 同じEPSG組のTransformer（PROJコンテキスト込み）をプロセス内で共有する
+    return pyproj.Transformer.from_crs(src_epsg, dst_epsg, always_xy=True)
+
 def calculate_projected_error(df_fix, transformer):
     if df_fix.empty: return np.nan, np.nan
     valid = df_fix.dropna(subset=['LatitudeDegrees', 'LongitudeDegrees'])
     if valid.empty: return np.nan, np.nan
-    
+
     # pyproj.Transformer (always_xy=True) -> lon, lat
-    xx, yy = transformer.transform(valid['LongitudeDegrees'].values, valid['LatitudeDegrees'].values)
-    
+    xx, yy = transformer.transform(
+        valid['LongitudeDegrees'].to_numpy(dtype=np.float64),
+        valid['LatitudeDegrees'].to_numpy(dtype=np.float64)
+    )
+
     med_x, med_y = np.median(xx), np.median(yy)
     dists = np.sqrt((xx - med_x)**2 + (yy - med_y)**2)
-    return np.percentile(dists, 50), np.percentile(dists, 95)
+    # p50/p95はソート2回のnp.percentileではなく、1回のpartitionでまとめて
+    # 抽出する（O(n)、線形補間＝np.percentileと同値）
+    n = dists.size
+    ks = np.array([(n - 1) * 0.50, (n - 1) * 0.95])
+    lo = ks.astype(np.int64)
+    hi = np.minimum(lo + 1, n - 1)
+    part = np.partition(dists, np.unique(np.concatenate([lo, hi])))
+    frac = ks - lo
+    p50, p95 = part[lo] + (part[hi] - part[lo]) * frac
+    return p50, p95
 
 def calculate_hdop_from_geometry(az, el):
     if len(az) < 4: return np.nan
     az_rad, el_rad = np.radians(az), np.radians(el)
     # G matrix for HDOP
-    G = np.column_stack([
-        -np.cos(el_rad)*np.sin(az_rad), 
-        -np.cos(el_rad)*np.cos(az_rad), 
-        -np.sin(el_rad), 
-        np.ones_like(az_rad)
-    ])
+    # 列ごとに一時配列を作ってcolumn_stackでコピーする代わりに、
+    # 事前確保したバッファへ out= で直接書く（エポックごとの割当てを削減）
+    G = np.empty((len(az_rad), 4), dtype=np.float64)
+    cos_el = np.cos(el_rad)
+    np.sin(az_rad, out=G[:, 0])
+    G[:, 0] *= -cos_el
+    np.cos(az_rad, out=G[:, 1])
+    G[:, 1] *= -cos_el
+    np.sin(el_rad, out=G[:, 2])
+    np.negative(G[:, 2], out=G[:, 2])
+    G[:, 3] = 1.0
     try:
         Q = np.linalg.inv(G.T @ G)
         return np.sqrt(Q[0, 0] + Q[1, 1])
@@ -82,6 +221,119 @@ def calculate_hdop_from_geometry(az, el):
         return np.nan
 
 
+# ==========================================
+# ログ1本分の処理 (ワーカープロセスでも実行される)
+# ==========================================
+def process_one_log(args):
+    """1ログを解析して ('ok', metrics) か ('fail', qc_record) を返す。
+
+    ログ同士は完全に独立なので ProcessPoolExecutor.map から呼ばれる。
+    pyproj.Transformer はfork非対応環境があるためワーカー内で生成する
+    （get_transformer のキャッシュによりプロセスごとに1回で済む）。
+    """
+    filepath, proj_epsg, qc_min_epochs, qc_min_duration = args
+    site_id = os.path.basename(filepath).split('_')[0]
+    df_fix, df_status, msg = parse_gnss_log(filepath)
+
+    if df_fix is None:
+        return 'fail', {'site_id': site_id, 'reason': f"Parse Error: {msg}"}
+
+    t_min, t_max = df_fix['UnixTimeMillis'].min(), df_fix['UnixTimeMillis'].max()
+    duration = (t_max - t_min) / 1000.0 if pd.notnull(t_min) else 0
+    n_fix = len(df_fix)
+
+    # QC Check
+    if n_fix < qc_min_epochs:
+        return 'fail', {'site_id': site_id, 'reason': f"Low Epochs ({n_fix})"}
+    if duration < qc_min_duration:
+        return 'fail', {'site_id': site_id, 'reason': f"Short Duration ({duration:.1f}s)"}
+
+    transformer = get_transformer("epsg:4326", proj_epsg)
+    err_p50, err_p95 = calculate_projected_error(df_fix, transformer)
+
+    # Status Metrics
+    df_used = df_status[df_status['UsedInFix'] == 1]
+    if df_used.empty:
+        return 'fail', {'site_id': site_id, 'reason': "No Used Satellites"}
+
+    # エポック列のハッシュgroupbyを3回（used集計＋カットオフ2回）作る代わりに、
+    # 時刻で一度だけ安定ソートした配列を全集計で共有する。
+    # NaN時刻の行はpandasのgroupbyがキーから落とすのに合わせて先に除外する。
+    ts = df_status['UnixTimeMillis'].to_numpy()
+    el = df_status['ElevationDegrees'].to_numpy(dtype=np.float64)
+    has_az = 'AzimuthDegrees' in df_status.columns
+    az = df_status['AzimuthDegrees'].to_numpy(dtype=np.float64) if has_az else None
+
+    ts_valid = np.isfinite(ts) if ts.dtype.kind == 'f' else np.ones(ts.size, dtype=bool)
+    used = (df_status['UsedInFix'].to_numpy() == 1) & ts_valid
+    order = np.argsort(ts, kind='stable')
+    order = order[ts_valid[order]]
+    ts_s = ts[order]
+    el_s = el[order]
+    az_s = az[order] if has_az else None
+    used_s = used[order]
+
+    # グループサイズの平均 = used行数 / usedが現れるユニークエポック数
+    ts_used = ts_s[used_s]
+    if ts_used.size == 0:
+        return 'fail', {'site_id': site_id, 'reason': "No Used Satellites"}
+    n_epochs_used = 1 + int(np.count_nonzero(ts_used[1:] != ts_used[:-1]))
+    used_sat_mean = ts_used.size / n_epochs_used
+
+    # HDOP Calculation
+    # カットは仰角の昇順（5°→15°）なのでBはAの部分集合。全量からマスクを
+    # 2回取り直す代わりに、Aで絞った配列をそのままBの入力にして絞り込む
+    hdop_results = {}
+    cut_ts, cut_az, cut_el = ts_s, az_s, el_s
+    for cut_name, min_el in [('hdop_cut_a', 5), ('hdop_cut_b', 15)]:
+        if not has_az or cut_el.size == 0:
+            hdop_results[f"{cut_name}_median"] = np.nan
+            continue
+        keep = cut_el >= min_el
+        if not keep.any():
+            hdop_results[f"{cut_name}_median"] = np.nan
+            cut_ts = cut_az = cut_el = np.empty(0)
+            continue
+        # マスクしてもソート順は保たれるので、境界オフセットはそのまま導出できる
+        cut_ts = cut_ts[keep]
+        cut_az = cut_az[keep]
+        cut_el = cut_el[keep]
+        starts = np.flatnonzero(np.r_[True, cut_ts[1:] != cut_ts[:-1]])
+        offsets = np.r_[starts, cut_ts.size].astype(np.int64)
+        if HAS_NUMBA:
+            hdop_arr = np.empty(offsets.size - 1)
+            _hdop_per_epoch(np.radians(cut_az), np.radians(cut_el), offsets, hdop_arr)
+            hdop_arr = hdop_arr[np.isfinite(hdop_arr) & (hdop_arr < 50)]
+            hdop_results[f"{cut_name}_median"] = float(np.median(hdop_arr)) if hdop_arr.size else np.nan
+        else:
+            hdops = []
+            for k in range(offsets.size - 1):
+                s, e = offsets[k], offsets[k + 1]
+                val = calculate_hdop_from_geometry(cut_az[s:e], cut_el[s:e])
+                if not np.isnan(val) and val < 50: hdops.append(val)
+            hdop_results[f"{cut_name}_median"] = np.median(hdops) if hdops else np.nan
+
+    # float32のまま縮約するとプラットフォーム間で丸めが揺れるため、
+    # 列はfloat32で保持しつつ累積だけfloat64で行う（NaNはpandas同様スキップ）
+    cn0 = df_used['Cn0DbHz'].to_numpy(dtype=np.float32, copy=False)
+    elev_used = df_used['ElevationDegrees'].to_numpy(dtype=np.float32, copy=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # 全NaN列はNaNを返せばよい
+        cn0_mean = float(np.nanmean(cn0, dtype=np.float64))
+        cn0_std = float(np.nanstd(cn0, ddof=1, dtype=np.float64))
+        elev_mean = float(np.nanmean(elev_used, dtype=np.float64))
+
+    return 'ok', {
+        'site_id': site_id, 'err_p95_m': err_p95, 'err_p50_m': err_p50,
+        'n_fix': n_fix, 'duration': duration, 'used_sat_mean': used_sat_mean,
+        'cn0_mean': cn0_mean, 'cn0_std': cn0_std,
+        'elev_mean': elev_mean,
+        'used_rate': len(df_used)/len(df_status) if len(df_status) > 0 else 0,
+        'hdop_cut_a_median': hdop_results['hdop_cut_a_median'],
+        'hdop_cut_b_median': hdop_results['hdop_cut_b_median']
+    }
+
+
 # ==========================================
 # メイン解析ロジック
 # ==========================================
@@ -106,68 +358,30 @@ def run_baseline_analysis(
     os.makedirs(os.path.join(run_dir, 'plots'), exist_ok=True)
     os.makedirs(os.path.join(latest_dir, 'plots'), exist_ok=True)
 
-    # 座標変換設定 (x=lon, y=lat)
-    transformer = pyproj.Transformer.from_crs("epsg:4326", proj_epsg, always_xy=True)
-
     # ログファイルの検索 (rawフォルダ直下の .txt)
-    log_files = glob.glob(os.path.join(log_dir, '*.txt'))
+    # globのfnmatch＋stat往復を避け、DirEntryのキャッシュ済みメタデータで判定する
+    with os.scandir(log_dir) as it:
+        log_files = sorted(e.path for e in it
+                           if e.is_file() and e.name.lower().endswith('.txt'))
     print(f"Found {len(log_files)} logs in {log_dir}")
-    
+
     qc_fails, site_metrics = [], []
-    
-    for filepath in log_files:
-        site_id = os.path.basename(filepath).split('_')[0]
-        df_fix, df_status, msg = parse_gnss_log(filepath)
-        
-        if df_fix is None:
-            qc_fails.append({'site_id': site_id, 'reason': f"Parse Error: {msg}"})
-            continue
-            
-        t_min, t_max = df_fix['UnixTimeMillis'].min(), df_fix['UnixTimeMillis'].max()
-        duration = (t_max - t_min) / 1000.0 if pd.notnull(t_min) else 0
-        n_fix = len(df_fix)
-        
-        # QC Check
-        if n_fix < qc_min_epochs:
-            qc_fails.append({'site_id': site_id, 'reason': f"Low Epochs ({n_fix})"})
-            continue
-        if duration < qc_min_duration:
-            qc_fails.append({'site_id': site_id, 'reason': f"Short Duration ({duration:.1f}s)"})
-            continue
-            
-        err_p50, err_p95 = calculate_projected_error(df_fix, transformer)
-        
-        # Status Metrics
-        df_used = df_status[df_status['UsedInFix'] == 1].copy()
-        if df_used.empty:
-             qc_fails.append({'site_id': site_id, 'reason': "No Used Satellites"})
-             continue
-
-        grp_used = df_used.groupby('UnixTimeMillis')
-        used_sat_mean = grp_used.size().mean()
-        
-        # HDOP Calculation
-        hdop_results = {}
-        for cut_name, min_el in [('hdop_cut_a', 5), ('hdop_cut_b', 15)]:
-            df_cut = df_status[df_status['ElevationDegrees'] >= min_el]
-            hdops = []
-            if not df_cut.empty:
-                for t, g in df_cut.groupby('UnixTimeMillis'):
-                    if 'AzimuthDegrees' in g.columns:
-                        val = calculate_hdop_from_geometry(g['AzimuthDegrees'].values, g['ElevationDegrees'].values)
-                        if not np.isnan(val) and val < 50: hdops.append(val)
-            hdop_results[f"{cut_name}_median"] = np.median(hdops) if hdops else np.nan
 
-        site_metrics.append({
-            'site_id': site_id, 'err_p95_m': err_p95, 'err_p50_m': err_p50,
-            'n_fix': n_fix, 'duration': duration, 'used_sat_mean': used_sat_mean,
-            'cn0_mean': df_used['Cn0DbHz'].mean(), 'cn0_std': df_used['Cn0DbHz'].std(),
-            'elev_mean': df_used['ElevationDegrees'].mean(),
-            'used_rate': len(df_used)/len(df_status) if len(df_status) > 0 else 0,
-            'hdop_cut_a_median': hdop_results['hdop_cut_a_median'],
-            'hdop_cut_b_median': hdop_results['hdop_cut_b_median']
-        })
-        print(f"Processed {site_id}: err95={err_p95:.2f}m")
+    # 各ログは完全に独立（パース＋数値縮約のCPUバウンド処理）なので、
+    # プロセスプールでコア数ぶん並列化する。図化と出力は主プロセスで行う。
+    job_args = [(fp, proj_epsg, qc_min_epochs, qc_min_duration) for fp in log_files]
+    # spawn必須: 親プロセスはインポート時にnumbaカーネルをウォームアップ
+    # しており、そのスレッド状態をforkで継承すると終了時にデッドロックする。
+    # spawnの子はモジュールを再インポートするが、cache=Trueのディスク
+    # キャッシュが効くので再コンパイルは走らない。
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             mp_context=multiprocessing.get_context("spawn")) as ex:
+        for kind, payload in ex.map(process_one_log, job_args, chunksize=4):
+            if kind == 'ok':
+                site_metrics.append(payload)
+                print(f"Processed {payload['site_id']}: err95={payload['err_p95_m']:.2f}m")
+            else:
+                qc_fails.append(payload)
 
     if qc_fails:
         pd.DataFrame(qc_fails).to_csv(os.path.join(run_dir, 'qc_fails.csv'), index=False)
@@ -210,38 +424,57 @@ def run_baseline_analysis(
     features = [f for f in possible_features if f in df_merged.columns]
     
     if features:
+        # 特徴量ごとに2列DataFrameを切り出してdropnaすると毎回コピーが走る。
+        # 行列と正解ラベルを一度だけ連続メモリに取り出し、列ごとの有限マスクで
+        # roc_curve にNumPyスライスを渡す
+        feat_mat = df_merged[features].to_numpy(dtype=np.float64)
+        y = df_merged['high_error'].to_numpy()
         auc_results = []
-        plt.figure(figsize=(8, 8))
-        for f in features:
-            tmp = df_merged[[f, 'high_error']].dropna()
-            if len(tmp['high_error'].unique()) < 2: continue
-            fpr, tpr, _ = roc_curve(tmp['high_error'], tmp[f])
+        # pyplotのグローバル登録に図を残さないようOOP APIで作り、保存後に閉じる
+        fig, ax = plt.subplots(figsize=(8, 8))
+        for i, f in enumerate(features):
+            col = feat_mat[:, i]
+            m = np.isfinite(col)
+            y_m = y[m]
+            if len(np.unique(y_m)) < 2: continue
+            fpr, tpr, _ = roc_curve(y_m, col[m])
             score = auc(fpr, tpr)
-            plt.plot(fpr, tpr, label=f'{f} (AUC={score:.2f})')
+            ax.plot(fpr, tpr, label=f'{f} (AUC={score:.2f})')
             auc_results.append(f"{f}: {score:.3f}")
-            
-        plt.plot([0,1],[0,1],'k--'); plt.legend(); plt.title('ROC Curves')
-        plt.savefig(os.path.join(run_dir, 'plots', 'roc_curves.png'))
+
+        ax.plot([0,1],[0,1],'k--'); ax.legend(); ax.set_title('ROC Curves')
+        fig.savefig(os.path.join(run_dir, 'plots', 'roc_curves.png'))
+        plt.close(fig)
         with open(os.path.join(run_dir, 'roc_auc.txt'), 'w') as f: f.write('\n'.join(auc_results))
-        
+
         # Scatter Plots
-        plt.figure(figsize=(15, 5))
+        fig, axes = plt.subplots(1, 3, figsize=(15, 5))
         for i, f in enumerate(features[:3]):
-            plt.subplot(1, 3, i+1)
-            plt.scatter(df_merged[f], df_merged['err_p95_m'], alpha=0.6)
-            plt.xlabel(f); plt.ylabel('Error p95 (m)')
-        plt.tight_layout()
-        plt.savefig(os.path.join(run_dir, 'plots', 'scatter_risk_err.png'))
+            axes[i].scatter(df_merged[f], df_merged['err_p95_m'], alpha=0.6)
+            axes[i].set_xlabel(f); axes[i].set_ylabel('Error p95 (m)')
+        fig.tight_layout()
+        fig.savefig(os.path.join(run_dir, 'plots', 'scatter_risk_err.png'))
+        plt.close(fig)
     else:
         print("[Info] Risk proxy columns not found in site definitions. Skipping plots.")
 
     # Copy results to 'latest'
+    # ハードリンクなら同一inodeの共有でファイルサイズ分のI/Oが発生しない。
+    # リンク不可（別ファイルシステム等）の場合のみ従来のコピーに落とす。
+    # latest/ 側のファイルは実体を共有するため読み取り専用として扱うこと。
+    def _publish(src, dst_dir):
+        dst = os.path.join(dst_dir, os.path.basename(src))
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+
     for f in glob.glob(os.path.join(run_dir, '*')):
         if os.path.isfile(f):
-            shutil.copy(f, latest_dir)
-            
+            _publish(f, latest_dir)
+
     for plot_file in glob.glob(os.path.join(run_dir, 'plots', '*')):
-        shutil.copy(plot_file, os.path.join(latest_dir, 'plots'))
+        _publish(plot_file, os.path.join(latest_dir, 'plots'))
 
     print(f"\nCompleted. Results in: {latest_dir}")
 
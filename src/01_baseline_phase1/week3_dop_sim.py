@@ -1,14 +1,106 @@
+import io
 import os
 import glob
 import math
-import csv
+import multiprocessing
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+# Numbaがあれば並列JIT版のHDOPカーネルを使う（無ければNumPy一括処理に
+# フォールバック）。cache=Trueでコンパイル結果をディスクに残し、
+# 2回目以降の実行ではコンパイル待ちをなくす。
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# pyarrowがあれば解析済みログをParquetにキャッシュする（2回目以降の実行で
+# テキストのトークン化を丸ごと省略できる）。無ければ毎回テキストを読む。
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 # ==========================================
 # 計算エンジン (DOP Simulator Logic)
 # ==========================================
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _hdop_epochs(az_rad, el_rad, offsets, out):
+        """エポックごとのHDOPをスカラー積み上げで計算するJITカーネル。
+
+        正規行列 G^T G は対称なので上三角10成分だけスカラーで積み、
+        一時配列を作らない。HDOPに要るのは逆行列の対角2成分だけなので、
+        フル逆行列は取らず、Cholesky分解＋前進代入2本で
+        Q[0,0]+Q[1,1] を直接求める（フルinvの約半分のフロップ数）。
+        ピボットが非正なら特異とみなしNaNを返す。
+        """
+        for k in prange(offsets.size - 1):
+            s = offsets[k]
+            e = offsets[k + 1]
+            if e - s < 4:
+                out[k] = np.nan
+                continue
+
+            ata = np.zeros((4, 4))
+            for i in range(s, e):
+                cos_el = np.cos(el_rad[i])
+                g0 = cos_el * np.sin(az_rad[i])
+                g1 = cos_el * np.cos(az_rad[i])
+                g2 = np.sin(el_rad[i])
+                ata[0, 0] += g0 * g0
+                ata[0, 1] += g0 * g1
+                ata[0, 2] += g0 * g2
+                ata[0, 3] += g0
+                ata[1, 1] += g1 * g1
+                ata[1, 2] += g1 * g2
+                ata[1, 3] += g1
+                ata[2, 2] += g2 * g2
+                ata[2, 3] += g2
+                ata[3, 3] += 1.0
+            # Cholesky分解 N = L L^T（上三角の積み上げ値を参照して下三角を作る）
+            ell = np.zeros((4, 4))
+            singular = False
+            for r in range(4):
+                for c in range(r + 1):
+                    acc = ata[c, r]
+                    for m in range(c):
+                        acc -= ell[r, m] * ell[c, m]
+                    if r == c:
+                        if acc <= 1e-12:
+                            singular = True
+                            break
+                        ell[r, c] = np.sqrt(acc)
+                    else:
+                        ell[r, c] = acc / ell[c, c]
+                if singular:
+                    break
+            if singular:
+                out[k] = np.nan
+                continue
+
+            # L y = e_j (j=0,1) の前進代入。Q[j,j] = ||L^{-1} e_j||^2 なので
+            # 2本の解ベクトルの二乗和がそのまま HDOP^2 になる。
+            q_sum = 0.0
+            for j in range(2):
+                x0 = 1.0 if j == 0 else 0.0
+                x1 = 1.0 if j == 1 else 0.0
+                x = np.zeros(4)
+                x[0] = x0 / ell[0, 0]
+                x[1] = (x1 - ell[1, 0] * x[0]) / ell[1, 1]
+                x[2] = (-ell[2, 0] * x[0] - ell[2, 1] * x[1]) / ell[2, 2]
+                x[3] = (-ell[3, 0] * x[0] - ell[3, 1] * x[1] - ell[3, 2] * x[2]) / ell[3, 3]
+                q_sum += x[0] * x[0] + x[1] * x[1] + x[2] * x[2] + x[3] * x[3]
+            out[k] = np.sqrt(q_sum)
+
+    # 初回実行時のコンパイルをインポート時に済ませておく（cacheヒット時は一瞬）
+    _hdop_epochs(np.zeros(4), np.zeros(4),
+                 np.array([0, 4], dtype=np.int64), np.empty(1))
+
 def calculate_hdop(satellites):
     """
     衛星の配置(Azimuth, Elevation)から、幾何学的精度低下率(HDOP)を計算する。
@@ -17,23 +109,21 @@ def calculate_hdop(satellites):
     if len(satellites) < 4:
         return np.nan  # 衛星が4機未満なら測位不能
 
-    G = []
-    for az_deg, el_deg in satellites:
-        # 角度をラジアンに変換
-        az = math.radians(az_deg)
-        el = math.radians(el_deg)
-        
-        # 視線ベクトル (East, North, Up)
-        # Azimuthは北基準時計回り前提
-        x = math.cos(el) * math.sin(az)
-        y = math.cos(el) * math.cos(az)
-        z = math.sin(el)
-        
-        # 時刻誤差項(1)を含めた行列
-        G.append([x, y, z, 1])
-    
-    G = np.array(G)
-    
+    # 衛星ごとのmath.cos/sin呼び出しとリストappendをやめ、
+    # (N,2)配列に対する一括のNumPy三角関数でG行列を組み立てる
+    arr = np.radians(np.asarray(satellites, dtype=np.float64))
+    az = arr[:, 0]
+    el = arr[:, 1]
+
+    # 視線ベクトル (East, North, Up) + 時刻誤差項(1)
+    # Azimuthは北基準時計回り前提
+    cos_el = np.cos(el)
+    G = np.empty((arr.shape[0], 4))
+    G[:, 0] = cos_el * np.sin(az)
+    G[:, 1] = cos_el * np.cos(az)
+    G[:, 2] = np.sin(el)
+    G[:, 3] = 1.0
+
     try:
         # (G^T * G) の逆行列を計算
         Q = np.linalg.inv(G.T @ G)
@@ -43,78 +133,130 @@ def calculate_hdop(satellites):
     except np.linalg.LinAlgError:
         return np.nan # 特異行列などで計算不能
 
-def parse_and_simulate(filepath):
+def calculate_hdop_batch(az_deg, el_deg, offsets):
+    """時刻順に整列済みの全衛星行から、エポックごとのHDOPを一括計算する。
+
+    offsets は各エポックの開始インデックス列（末尾に総行数を含む長さE+1）。
+    正規行列 G^T G を reduceat でエポック単位に束ね、(E,4,4) スタックを
+    1回の np.linalg.inv でまとめて逆行列化する。LAPACKへのディスパッチが
+    エポック数に依存しなくなる。Numbaがあれば並列JITカーネルに委譲する。
+    """
+    az = np.radians(np.asarray(az_deg, dtype=np.float64))
+    el = np.radians(np.asarray(el_deg, dtype=np.float64))
+    if HAS_NUMBA:
+        out = np.empty(offsets.size - 1)
+        _hdop_epochs(az, el, np.asarray(offsets, dtype=np.int64), out)
+        return out
+    n = az.size
+    cos_el = np.cos(el)
+    G = np.empty((n, 4))
+    G[:, 0] = cos_el * np.sin(az)
+    G[:, 1] = cos_el * np.cos(az)
+    G[:, 2] = np.sin(el)
+    G[:, 3] = 1.0
+
+    starts = offsets[:-1]
+    counts = np.diff(offsets)
+    # 行ごとの外積 (n,16) をエポック単位に加算して正規行列スタックにする
+    prods = (G[:, :, None] * G[:, None, :]).reshape(n, 16)
+    norm_mats = np.add.reduceat(prods, starts, axis=0).reshape(-1, 4, 4)
+
+    hdop = np.full(starts.size, np.nan)
+    ok = counts >= 4  # 衛星4機未満のエポックは測位不能
+    if ok.any():
+        sel = norm_mats[ok]
+        # 特異な正規行列は行列式で先に弾く（一括invは1つでも特異だと失敗する）
+        good = np.abs(np.linalg.det(sel)) > 1e-12
+        idx = np.flatnonzero(ok)[good]
+        if idx.size:
+            Q = np.linalg.inv(sel[good])
+            hdop[idx] = np.sqrt(Q[:, 0, 0] + Q[:, 1, 1])
+    return hdop
+
+def parse_and_simulate(filepath, use_cache=True):
     """
     1つのログファイルを読み込み、Cut-A(5度)とCut-B(15度)のHDOPを計算する
     """
-    # データを格納する辞書: time -> list of (az, el)
-    epochs = {}
-    
-    # pathlib.Pathオブジェクトか確認して文字列化（openで使うため）あるいはPathのままopen
     path_obj = Path(filepath)
     print(f"Processing: {path_obj.name} ...")
-    
-    with path_obj.open("r", encoding="utf-8", errors="ignore") as f:
-        reader = csv.reader(f)
-        header_map = {}
-        
-        for row in reader:
-            if not row: continue
-            
-            # ヘッダー行の解析 (# Status, UnixTimeMillis, ...)
-            if row[0].startswith("#") and "Status" in row[0]:
-                clean_row = [c.strip().replace("#", "").strip() for c in row]
-                try:
-                    type_idx = clean_row.index("Status")
-                    for i, col in enumerate(clean_row[type_idx+1:]):
-                        header_map[col] = type_idx + 1 + i
-                except ValueError:
-                    pass
-                continue
 
-            # データ行の解析
-            if row[0].strip() == "Status":
-                try:
-                    idx_time = header_map.get("UnixTimeMillis")
-                    idx_el = header_map.get("ElevationDegrees")
-                    idx_az = header_map.get("AzimuthDegrees")
-                    
-                    if idx_time is None or idx_el is None or idx_az is None:
-                        continue
-                        
-                    t = row[idx_time]
-                    el = float(row[idx_el])
-                    az = float(row[idx_az])
-                    
-                    if t not in epochs:
-                        epochs[t] = []
-                    epochs[t].append((az, el))
-                except (ValueError, IndexError):
-                    continue
+    needed = ("UnixTimeMillis", "ElevationDegrees", "AzimuthDegrees")
 
-    # --- シミュレーション実行 ---
-    stats_a = []
-    stats_b = []
-    
-    for t, sats in epochs.items():
-        # Cut-A: 5度以上
-        sats_a = [(az, el) for (az, el) in sats if el >= 5.0]
-        hdop_a = calculate_hdop(sats_a)
-        
-        # Cut-B: 15度以上
-        sats_b = [(az, el) for (az, el) in sats if el >= 15.0]
-        hdop_b = calculate_hdop(sats_b)
-        
-        if not np.isnan(hdop_a): stats_a.append(hdop_a)
-        if not np.isnan(hdop_b): stats_b.append(hdop_b)
-
-    return {
+    result = {
         "site_id": path_obj.stem.split("_")[0],
-        "hdop_cut_a_median": np.nanmedian(stats_a) if stats_a else np.nan,
-        "hdop_cut_b_median": np.nanmedian(stats_b) if stats_b else np.nan,
-        "valid_epochs": len(epochs)
+        "hdop_cut_a_median": np.nan,
+        "hdop_cut_b_median": np.nan,
+        "valid_epochs": 0,
     }
 
+    # ログと同じ場所のParquetキャッシュが新しければテキスト解析を省略する
+    cache_path = path_obj.with_suffix(".parquet")
+    df = None
+    if use_cache and HAS_PYARROW and cache_path.exists() \
+            and cache_path.stat().st_mtime >= path_obj.stat().st_mtime:
+        df = pd.read_parquet(cache_path, columns=list(needed))
+
+    if df is None:
+        # 行ごとのcsv.reader＋フィールドごとのfloat()をやめ、Status行だけを
+        # バッファに集めてpandasのCパーサに一括でトークン化・数値化させる
+        header_cols = None
+        buf = io.StringIO()
+
+        with path_obj.open("r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                if line.startswith("Status,"):
+                    buf.write(line)
+                elif line.startswith("#") and "Status" in line:
+                    # ヘッダー行の解析 (# Status, UnixTimeMillis, ...)
+                    clean = [c.strip().replace("#", "").strip() for c in line.split(",")]
+                    try:
+                        type_idx = clean.index("Status")
+                        header_cols = clean[type_idx:]
+                    except ValueError:
+                        pass
+
+        if header_cols is None or not all(c in header_cols for c in needed):
+            return result
+
+        buf.seek(0)
+        df = pd.read_csv(buf, names=header_cols, usecols=list(needed),
+                         engine="c", on_bad_lines="skip")
+        for c in needed:
+            if not pd.api.types.is_numeric_dtype(df[c]):
+                df[c] = pd.to_numeric(df[c], errors="coerce")
+        df = df.dropna()
+
+        if use_cache and HAS_PYARROW:
+            df.to_parquet(cache_path, compression="zstd")
+
+    if df.empty:
+        return result
+
+    # --- シミュレーション実行 ---
+    # エポック辞書もタプルリストも作らず、時刻で安定ソートした配列に
+    # 連番のエポックIDを振り、カットごとにマスク＋一括計算する
+    ts = df["UnixTimeMillis"].to_numpy()
+    order = np.argsort(ts, kind="stable")
+    ts = ts[order]
+    az_all = df["AzimuthDegrees"].to_numpy()[order]
+    el_all = df["ElevationDegrees"].to_numpy()[order]
+    epoch_ids = np.cumsum(np.r_[0, ts[1:] != ts[:-1]])
+    result["valid_epochs"] = int(epoch_ids[-1]) + 1
+
+    for name, min_el in (("hdop_cut_a_median", 5.0), ("hdop_cut_b_median", 15.0)):
+        m = el_all >= min_el
+        ids_m = epoch_ids[m]
+        if ids_m.size == 0:
+            continue
+        starts = np.flatnonzero(np.r_[True, ids_m[1:] != ids_m[:-1]])
+        offsets = np.r_[starts, ids_m.size]
+        h = calculate_hdop_batch(az_all[m], el_all[m], offsets)
+        h = h[np.isfinite(h)]
+        if h.size:
+            result[name] = float(np.median(h))
+
+    return result
+
 # ==========================================
 # メイン処理関数 (モジュール化)
 # ==========================================
@@ -135,11 +277,15 @@ def run_dop_simulation(input_dir, output_csv_path):
 
     print(f"Found {len(log_files)} logs in {input_dir}")
 
-    results = []
-    for log_file in log_files:
-        res = parse_and_simulate(log_file)
-        results.append(res)
-    
+    # ファイル間に依存はないのでプロセスプールで並列化する
+    # （parse_and_simulateはモジュールレベル関数なのでそのままpickle可能）。
+    # spawn必須: 親はインポート時にnumbaカーネルをウォームアップ済みで、
+    # そのスレッド状態をforkで継承すると終了時にデッドロックする。
+    # spawnの子の再インポートはcache=Trueのディスクキャッシュで速い。
+    with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = list(pool.map(parse_and_simulate, log_files, chunksize=2))
+
     df = pd.DataFrame(results)
     df.to_csv(output_csv_path, index=False)
     
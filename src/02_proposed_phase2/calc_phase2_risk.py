@@ -1,9 +1,18 @@
 import os
-import math
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
+from shapely.strtree import STRtree
+
+# pyogrioがあれば列指向の一括読みエンジンでGPKGをロードする
+# （Fionaの行単位読みより大幅に速く、不要な属性列も読み飛ばせる）
+try:
+    import pyogrio
+    HAS_PYOGRIO = True
+except ImportError:
+    HAS_PYOGRIO = False
 
 # ==========================================
 # 定数・設定
@@ -20,68 +29,128 @@ OVERHEAD_BUFFER_M = 2.0
 # ==========================================
 # ヘルパー関数群
 # ==========================================
+POSSIBLE_HEIGHT_COLS = ["measuredHeight", "bldg_measuredHeight", "height", "z"]
+
 def _pick_height_col(gdf):
-    possible_cols = ["measuredHeight", "bldg_measuredHeight", "height", "z"]
-    for c in possible_cols:
+    for c in POSSIBLE_HEIGHT_COLS:
         if c in gdf.columns:
             return c
     return None
 
-def risk_max_score(point, obstacles_gdf, radius_m, dist_scale_m=10.0):
-    """MAX方式: 最も影響度の高い障害物のスコアを採用"""
+def _height_array(gdf):
+    """高さ属性をfloat64配列に1回だけ正規化する。
+
+    欠損・数値化できない値は DEFAULT_HEIGHT に置き換える。スコアリング側は
+    この配列を信用してよく、行ごとのpd.notna/float()変換は不要になる。
+    """
+    col = _pick_height_col(gdf)
+    if col is None:
+        return np.full(len(gdf), DEFAULT_HEIGHT)
+    h = pd.to_numeric(gdf[col], errors="coerce").to_numpy(dtype=np.float64, copy=True)
+    np.nan_to_num(h, copy=False, nan=DEFAULT_HEIGHT)
+    return h
+
+def _read_vector(path):
+    """障害物レイヤを読み込む。
+
+    pyogrioがあればレイヤ情報から高さ候補列だけを選んで読み込み、
+    geometry＋高さ以外の属性列のIOとメモリを省く。無ければFionaに
+    フォールバックして全列を読む（挙動は同じ）。
+    """
+    if not HAS_PYOGRIO:
+        return gpd.read_file(path)
+    info = pyogrio.read_info(path)
+    cols = [c for c in info.get("fields", []) if c in POSSIBLE_HEIGHT_COLS]
+    return gpd.read_file(path, engine="pyogrio", columns=cols)
+
+def risk_max_score(point, obstacles_geoms, obstacles_heights, sindex, radius_m, dist_scale_m=10.0):
+    """MAX方式: 最も影響度の高い障害物のスコアを採用
+
+    sindexと geometry/高さの素の配列は呼び出し側でループ外に1回だけ
+    用意しておく（サイトごとのインデックス再構築・DataFrameスライスをしない）。
+    """
     buf = point.buffer(radius_m)
-    # 空間インデックスが利用可能な場合は活用（パフォーマンス向上）
-    if obstacles_gdf.sindex:
-        possible_matches_index = list(obstacles_gdf.sindex.intersection(buf.bounds))
-        possible_matches = obstacles_gdf.iloc[possible_matches_index]
-        nearby = possible_matches[possible_matches.intersects(buf)].copy()
-    else:
-        nearby = obstacles_gdf[obstacles_gdf.intersects(buf)].copy()
-
-    if len(nearby) == 0:
+    # bbox候補の列挙→intersectsの絞り込みまでC側で完結する
+    candidates = sindex.query(buf, predicate="intersects")
+
+    if candidates.size == 0:
         return 0.0
 
-    height_col = _pick_height_col(nearby)
-    max_score = 0.0
-    
-    for _, row in nearby.iterrows():
-        dist = row.geometry.distance(point)
-        if dist < 0.1: dist = 0.1
-
-        h = DEFAULT_HEIGHT
-        if height_col and pd.notna(row[height_col]):
-            try: h = float(row[height_col])
-            except: pass
-
-        rel_h = h - CALC_HEIGHT_M
-        if rel_h <= 0: continue
-
-        elev_angle = math.degrees(math.atan2(rel_h, dist))
-        angle_score = elev_angle / 90.0
-        dist_score = 1.0 / (1.0 + dist / dist_scale_m)
-        
-        obj_score = angle_score * dist_score
-        if obj_score > max_score:
-            max_score = obj_score
-
-    return float(min(max(max_score, 0.0), 1.0))
-
-def overhead_score_binary(point, brid_gdf, buffer_m):
-    """高架直下判定 (バッファ付き)"""
+    # 候補1件ずつ geometry.distance を呼ぶPythonディスパッチをやめ、
+    # shapely 2 の配列APIで距離・スコアを一括計算する
+    dists = np.maximum(shapely.distance(obstacles_geoms[candidates], point), 0.1)
+
+    # obstacles_heights は _height_array で正規化済みのfloat64配列
+    rel_h = obstacles_heights[candidates] - CALC_HEIGHT_M
+    m = rel_h > 0
+    if not m.any():
+        return 0.0
+
+    elev_angle = np.degrees(np.arctan2(rel_h[m], dists[m]))
+    scores = (elev_angle / 90.0) * (1.0 / (1.0 + dists[m] / dist_scale_m))
+
+    return float(min(max(scores.max(), 0.0), 1.0))
+
+def risk_max_scores_batched(sites_gdf, site_bufs, obstacles_gdf, obstacles_heights, dist_scale_m=10.0):
+    """全サイトのMAXスコアを1回の空間結合でまとめて計算する。
+
+    site_bufs はバッファ済みサイトgeometryの配列。shapelyのバッファ生成
+    （円の多角形化）は安くないので、呼び出し側で1回だけ作って
+    建物・橋の両クエリに使い回す。
+
+    サイトごとにバッファ→sindex照会を繰り返す代わりに、STRtreeの
+    配列クエリで全バッファ×障害物のペアを一括列挙し、スコア式をNumPyで
+    評価してから np.maximum.at でサイト単位のMAXに畳む（sjoinのような
+    中間DataFrameを作らない）。1サイトずつの risk_max_score と同じ値を
+    返す（MAX集約なので順序に依存しない）。
+    """
+    scores = np.zeros(len(sites_gdf))
+    if len(obstacles_gdf) == 0:
+        return scores
+
+    site_geoms = sites_gdf.geometry.values
+    obstacle_geoms = obstacles_gdf.geometry.values
+    tree = STRtree(obstacle_geoms)
+    li, ri = tree.query(site_bufs, predicate="intersects")
+    if li.size == 0:
+        return scores
+
+    dists = np.maximum(shapely.distance(obstacle_geoms[ri], site_geoms[li]), 0.1)
+    rel_h = obstacles_heights[ri] - CALC_HEIGHT_M
+    m = rel_h > 0
+    if not m.any():
+        return scores
+
+    elev_angle = np.degrees(np.arctan2(rel_h[m], dists[m]))
+    pair_scores = (elev_angle / 90.0) * (1.0 / (1.0 + dists[m] / dist_scale_m))
+
+    np.maximum.at(scores, li[m], pair_scores)
+    return np.clip(scores, 0.0, 1.0)
+
+def overhead_flags_batched(sites_gdf, brid_gdf, max_dist):
+    """全サイトの高架直下フラグを1回の一括ツリー照会でまとめて判定する。
+
+    「バッファ円と交差するか」は「点から橋までの距離 <= max_dist」と
+    等価なので、円の多角形化を挟まず dwithin 述語で直接判定する
+    （多角形近似による縁の誤差もなくなる）。
+    """
+    flags = np.zeros(len(sites_gdf), dtype=np.int64)
     if brid_gdf is None or len(brid_gdf) == 0:
+        return flags
+
+    tree = STRtree(brid_gdf.geometry.values)
+    li, _ = tree.query(sites_gdf.geometry.values,
+                       predicate="dwithin", distance=max_dist)
+    flags[np.unique(li)] = 1
+    return flags
+
+def overhead_score_binary(point, brid_sindex, buffer_m):
+    """高架直下判定 (距離判定: バッファ円との交差と等価・A11救済策)"""
+    if brid_sindex is None:
         return 0, 0.0
-    
-    # 点の周りにバッファを張って接触判定（A11救済策）
-    pbuf = point.buffer(buffer_m)
-    
-    if brid_gdf.sindex:
-        possible_matches_index = list(brid_gdf.sindex.intersection(pbuf.bounds))
-        possible_matches = brid_gdf.iloc[possible_matches_index]
-        hit = possible_matches.intersects(pbuf).any()
-    else:
-        hit = brid_gdf.intersects(pbuf).any()
-    
-    if hit: return 1, 1.0
+
+    if brid_sindex.query(point, predicate="dwithin", distance=buffer_m).size > 0:
+        return 1, 1.0
     return 0, 0.0
 
 # ==========================================
@@ -96,10 +165,8 @@ def calculate_phase2_risk(
 ):
     print(f"--- Phase 2: Risk Calculation (Bldg + Bridge) ---")
     
-    # 出力ディレクトリ作成
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-        print(f"[*] ディレクトリを作成しました: {output_dir}")
+    # 出力ディレクトリ作成 (exist_ok=Trueなので存在チェックは不要)
+    os.makedirs(output_dir, exist_ok=True)
     
     # ファイル存在確認
     for p in [input_bldg_path, input_brid_path, input_sites_csv]:
@@ -116,46 +183,50 @@ def calculate_phase2_risk(
     sites_gdf = gpd.GeoDataFrame(sites_df, geometry=geometry, crs=CRS_METRIC)
     
     # 2. 障害物データの読み込み
-    bldg_gdf = gpd.read_file(input_bldg_path).to_crs(CRS_METRIC)
-    brid_gdf = gpd.read_file(input_brid_path).to_crs(CRS_METRIC)
-    
-    # 従来互換用の全結合データ (risk_proxy_5m 相当の計算用)
-    all_obstacles = pd.concat([bldg_gdf, brid_gdf], ignore_index=True)
+    bldg_gdf = _read_vector(input_bldg_path).to_crs(CRS_METRIC)
+    brid_gdf = _read_vector(input_brid_path).to_crs(CRS_METRIC)
 
     print(f"Sites: {len(sites_gdf)}, Bldgs: {len(bldg_gdf)}, Bridges: {len(brid_gdf)}")
     print(f"Calculating with Overhead Buffer = {OVERHEAD_BUFFER_M}m ...")
 
-    results = []
-    
-    for idx, site in sites_gdf.iterrows():
-        # 1. 従来の全部入り (risk_proxy_5m)
-        risk_all = risk_max_score(site.geometry, all_obstacles, SEARCH_RADIUS_M)
-        
-        # 2. Risk Horizon (建物のみ)
-        risk_h = risk_max_score(site.geometry, bldg_gdf, SEARCH_RADIUS_M)
-        
-        # 3. Overhead Score (橋のみ、バッファあり)
-        oflag, oscore = overhead_score_binary(site.geometry, brid_gdf, buffer_m=OVERHEAD_BUFFER_M)
-
-        # A11のデバッグ表示 (既存ロジック維持)
-        if str(site['site_id']) == 'A11':
-            status = "SUCCESS" if oflag == 1 else "FAIL"
-            print(f"  [CHECK A11] Overhead Flag: {oflag} ({status}) | Horizon: {risk_h:.3f}")
-
-        results.append({
-            'site_id': site['site_id'],
-            'class': site['class'] if 'class' in site else 0, # カラムが無い場合の安全策
-            'center_x_6677': site['center_x_6677'],
-            'center_y_6677': site['center_y_6677'],
-            'risk_proxy_5m': risk_all,
-            'svf_proxy_5m': 1.0 - risk_all,
-            'risk_horizon': risk_h,
-            'overhead_flag': oflag,
-            'overhead_score': oscore
-        })
+    # サイトごとの逐次呼び出しではなく、バッファ済み全サイト×障害物の
+    # 空間結合1回＋ベクトル化スコアリングで3種類の指標を一括計算する
+    heights = _height_array(bldg_gdf)
+    brid_heights = _height_array(brid_gdf)
+
+    # サイトバッファは1回だけ作り、建物・橋の両クエリで使い回す
+    search_bufs = sites_gdf.geometry.buffer(SEARCH_RADIUS_M).values
+
+    # 2. Risk Horizon (建物のみ)
+    risk_h = risk_max_scores_batched(sites_gdf, search_bufs, bldg_gdf, heights)
+
+    # 1. 従来の全部入り (risk_proxy_5m)
+    # MAX集約なので「建物∪橋のMAX」＝「建物MAXと橋MAXの大きい方」。
+    # 全結合フレーム(pd.concat)を作って3回目の空間結合を回す必要はない。
+    risk_br = risk_max_scores_batched(sites_gdf, search_bufs, brid_gdf, brid_heights)
+    risk_all = np.maximum(risk_h, risk_br)
+
+    # 3. Overhead Score (橋のみ、距離判定)
+    oflag = overhead_flags_batched(sites_gdf, brid_gdf, max_dist=OVERHEAD_BUFFER_M)
+
+    # A11のデバッグ表示 (既存ロジック維持)
+    site_ids = sites_gdf['site_id'].astype(str).to_numpy()
+    for i in np.flatnonzero(site_ids == 'A11'):
+        status = "SUCCESS" if oflag[i] == 1 else "FAIL"
+        print(f"  [CHECK A11] Overhead Flag: {oflag[i]} ({status}) | Horizon: {risk_h[i]:.3f}")
 
     # 保存
-    out_df = pd.DataFrame(results)
+    out_df = pd.DataFrame({
+        'site_id': sites_gdf['site_id'].to_numpy(),
+        'class': sites_gdf['class'].to_numpy() if 'class' in sites_gdf.columns else 0, # カラムが無い場合の安全策
+        'center_x_6677': sites_gdf['center_x_6677'].to_numpy(),
+        'center_y_6677': sites_gdf['center_y_6677'].to_numpy(),
+        'risk_proxy_5m': risk_all,
+        'svf_proxy_5m': 1.0 - risk_all,
+        'risk_horizon': risk_h,
+        'overhead_flag': oflag,
+        'overhead_score': oflag.astype(np.float64)
+    })
     output_path = os.path.join(output_dir, output_filename)
     out_df.to_csv(output_path, index=False)
     print(f"Saved to: {output_path}")
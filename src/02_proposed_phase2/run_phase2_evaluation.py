@@ -1,21 +1,62 @@
 import os
 import pandas as pd
 import numpy as np
-from sklearn.metrics import roc_auc_score
+from scipy.stats import rankdata
 import warnings
 
 # 警告抑制
 warnings.filterwarnings("ignore")
 
+# pyarrowがあればマルチスレッドのArrowパーサでCSVを読む
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
 # ==========================================
 # 定数・設定
 # ==========================================
 HIGH_ERROR_QUANTILE = 0.70  # 上位30%を高誤差（危険）とする
 FOCUS_SITES = ["A11", "A06"] # 特定の注目サイト（A11:高架下, A06:最大誤差）
 
+# Riskデータから下流（評価・検定・図版）が実際に参照する列。
+# これ以外の列は結合前に落とし、ハッシュ結合とfinal_datasetを小さく保つ。
+RISK_KEEP = [
+    'site_id',
+    'center_x_6677', 'center_y_6677',   # 空間リスクマップ用の座標
+    'risk_proxy_5m', 'risk_horizon',
+    'overhead_flag', 'overhead_score',
+]
+
 # ==========================================
 # ヘルパー関数
 # ==========================================
+def _read_csv(path, cols=None):
+    """CSVを読み込む。pyarrowエンジンが使えればそちらを優先する。
+
+    cols を渡すと必要な列だけ取り込む（列プルーニング）。
+    """
+    if HAS_PYARROW:
+        try:
+            return pd.read_csv(path, engine="pyarrow", usecols=cols)
+        except (ValueError, TypeError, KeyError):
+            # KeyError: pyarrowは列不足をArrowKeyErrorで返す→Cエンジンで再判定
+            pass
+    return pd.read_csv(path, usecols=cols)
+
+def _as_key(series):
+    """結合キー(site_id)を文字列型に統一する。
+
+    pyarrowがあればArrowバックエンドの文字列型を使う（object型の
+    Pythonオブジェクトハッシュを避け、merge時のハッシュ表が軽くなる）。
+    既に目的のdtypeならコピーせずそのまま返す。
+    """
+    target = 'string[pyarrow]' if HAS_PYARROW else str
+    if series.dtype == target:
+        return series
+    return series.astype(target)
+
 def calculate_safety_metrics(df, y_col, score_col, model_name, focus_sites=FOCUS_SITES):
     """
     指定されたスコアについてAUCとSafety Metrics (Rank) を計算する。
@@ -36,7 +77,9 @@ def calculate_safety_metrics(df, y_col, score_col, model_name, focus_sites=FOCUS
     if len(np.unique(y)) < 2:
         return None
 
-    # AUC計算
+    # AUC計算 (このヘルパーを使うときだけsklearnを読み込む。
+    # 一括評価のメイン経路は calculate_safety_metrics_batch でsklearn不要)
+    from sklearn.metrics import roc_auc_score
     try:
         auc_raw = roc_auc_score(y, s)
     except ValueError:
@@ -79,34 +122,106 @@ def calculate_safety_metrics(df, y_col, score_col, model_name, focus_sites=FOCUS
             
     return res
 
+def calculate_safety_metrics_batch(df, y_col, targets, focus_sites=FOCUS_SITES):
+    """複数スコア列のAUCとSafety Metrics (Rank) を一括計算する。
+
+    calculate_safety_metrics をスコア列ごとに呼ぶと列ごとに同じ正解
+    ベクトルでソート・ランク付けを繰り返すので、(N, K) のスコア行列に
+    まとめて rankdata(axis=0) 1回でAUC（Mann-WhitneyのU統計量）を出す。
+    欠損を含む列だけ個別にマスクして同じ式で計算する。
+
+    戻り値は calculate_safety_metrics の結果dictのリスト（列順）。
+    AUC < 0.5 の反転規則・注目サイトの順位付けは従来と同じだが、
+    順位のタイ内順序は安定ソートで決める。
+    """
+    present = [(c, n) for c, n in targets if c in df.columns]
+    if not present:
+        return []
+
+    site_ids = df['site_id'].astype(str).to_numpy()
+    y_all = df[y_col].to_numpy(dtype=np.float64)
+    err_all = df['err_p95_m'].to_numpy(dtype=np.float64)
+    scores_mat = df[[c for c, _ in present]].to_numpy(dtype=np.float64)
+    # 従来のdropnaと同じ行除外規則（y・err・スコアのいずれか欠損で除外）
+    base_valid = ~(np.isnan(y_all) | np.isnan(err_all))
+    valid = base_valid[:, None] & ~np.isnan(scores_mat)
+
+    results = []
+    all_valid = bool(valid.all())
+    if all_valid:
+        # 欠損なし: 1回のrankdataで全列のU統計量をまとめて計算
+        r = rankdata(scores_mat, method="average", axis=0)
+        n_pos = float((y_all == 1).sum())
+        n_neg = float((y_all == 0).sum())
+
+    for k, (col, name) in enumerate(present):
+        m = valid[:, k]
+        y = y_all[m]
+        s = scores_mat[m, k]
+
+        # クラスが1つしかない場合は計算不可
+        if np.unique(y).size < 2:
+            results.append(None)
+            continue
+
+        if all_valid:
+            u = (r[:, k] * y_all).sum() - n_pos * (n_pos + 1) / 2.0
+            auc_raw = u / (n_pos * n_neg)
+        else:
+            rk = rankdata(s, method="average")
+            np_k = float((y == 1).sum())
+            nn_k = float((y == 0).sum())
+            u = (rk * y).sum() - np_k * (np_k + 1) / 2.0
+            auc_raw = u / (np_k * nn_k)
+
+        # ランキング用にスコアの向きを揃える (AUC < 0.5 なら反転)
+        flipped = bool(auc_raw < 0.5)
+        s_used = -s if flipped else s
+        auc_used = 1.0 - auc_raw if flipped else auc_raw
+
+        res = {
+            "Model": name,
+            "Score": col,
+            "AUC": round(auc_used, 3),
+            "Flipped": flipped,
+        }
+
+        # 特定サイトの順位 (スコアが高いほど危険 = 高ランク, 1-based)
+        order = np.argsort(-s_used, kind="stable")
+        ids_sorted = site_ids[m][order]
+        for site in focus_sites:
+            hit = np.flatnonzero(ids_sorted == str(site))
+            res[f"Rank({site})"] = int(hit[0]) + 1 if hit.size else "-"
+
+        results.append(res)
+
+    return results
+
 # ==========================================
 # メイン処理関数
 # ==========================================
 def run_phase2_evaluation(risk_csv_path, baseline_metrics_path, dop_csv_path, output_dir, final_dataset_path):
     print("--- Phase 2: Analysis Pipeline (Safety Metrics) ---")
     
-    # 出力ディレクトリ作成
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-    
+    # 出力ディレクトリ作成 (exist_ok=Trueなので存在チェックは不要)
+    os.makedirs(output_dir, exist_ok=True)
+
     # final_dataset.csv の保存先ディレクトリ作成
-    final_data_dir = os.path.dirname(final_dataset_path)
-    if not os.path.exists(final_data_dir):
-        os.makedirs(final_data_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(final_dataset_path), exist_ok=True)
 
     # 1. ファイル読み込み
     # Phase 2 Risk (今回計算した指標)
     if not os.path.exists(risk_csv_path):
         raise FileNotFoundError(f"Risk metrics file not found: {risk_csv_path}\nPlease run calc_phase2_risk.py first.")
-    df_risk = pd.read_csv(risk_csv_path)
+    df_risk = _read_csv(risk_csv_path)
     # サイトIDを文字列型に統一
-    df_risk['site_id'] = df_risk['site_id'].astype(str)
+    df_risk['site_id'] = _as_key(df_risk['site_id'])
 
     # Phase 1 Metrics (誤差正解データ: err_p95_m)
     if not os.path.exists(baseline_metrics_path):
         raise FileNotFoundError(f"Baseline metrics file not found: {baseline_metrics_path}")
-    df_metrics = pd.read_csv(baseline_metrics_path)
-    df_metrics['site_id'] = df_metrics['site_id'].astype(str)
+    df_metrics = _read_csv(baseline_metrics_path)
+    df_metrics['site_id'] = _as_key(df_metrics['site_id'])
     
     print(f"Loaded Risk Data: {len(df_risk)} sites")
     print(f"Loaded Baseline Data: {len(df_metrics)} sites")
@@ -114,8 +229,12 @@ def run_phase2_evaluation(risk_csv_path, baseline_metrics_path, dop_csv_path, ou
     # 2. データの結合
     # DOPデータ (HDOP Benchmark用) は任意
     if os.path.exists(dop_csv_path):
-        df_dop = pd.read_csv(dop_csv_path)
-        df_dop['site_id'] = df_dop['site_id'].astype(str)
+        # DOP結果から実際に使う2列だけ読む（列が無い古い形式なら全列読み）
+        try:
+            df_dop = _read_csv(dop_csv_path, cols=['site_id', 'hdop_cut_a_median'])
+        except ValueError:
+            df_dop = _read_csv(dop_csv_path)
+        df_dop['site_id'] = _as_key(df_dop['site_id'])
         # 必要なカラムだけ結合
         if 'hdop_cut_a_median' in df_dop.columns:
             df_metrics = pd.merge(df_metrics, df_dop[['site_id', 'hdop_cut_a_median']], on='site_id', how='left')
@@ -124,8 +243,9 @@ def run_phase2_evaluation(risk_csv_path, baseline_metrics_path, dop_csv_path, ou
         print(f"Warning: DOP file not found ({dop_csv_path}). Skipping HDOP benchmark.")
 
     # Riskデータと結合 (Phase 1の結果をベースに Phase 2のスコアを付与)
-    # カラム重複を防ぐため、df_riskからはmetricsに含まれていないカラムのみ採用
-    cols_to_use = [c for c in df_risk.columns if c not in df_metrics.columns or c == 'site_id']
+    # カラム重複を防ぎつつ、下流で使う列(RISK_KEEP)だけに絞って結合する
+    cols_to_use = [c for c in RISK_KEEP
+                   if c in df_risk.columns and (c == 'site_id' or c not in df_metrics.columns)]
     df_merged = pd.merge(df_metrics, df_risk[cols_to_use], on='site_id', how='inner')
     
     print(f"Merged Data: {len(df_merged)} sites")
@@ -134,17 +254,27 @@ def run_phase2_evaluation(risk_csv_path, baseline_metrics_path, dop_csv_path, ou
     df_merged.to_csv(final_dataset_path, index=False)
     print(f"Saved final dataset to: {final_dataset_path}")
 
+    # 下流スクリプト(検定・図版)向けにParquet版も併置する。
+    # 型付き・列指向なのでCSV再パースより数倍速く読める。CSVが正は変わらず、
+    # Parquetはあくまで高速読み込み用のサイドカー。
+    if HAS_PYARROW:
+        parquet_path = os.path.splitext(final_dataset_path)[0] + '.parquet'
+        df_merged.to_parquet(parquet_path, index=False)
+        print(f"Saved parquet sidecar to: {parquet_path}")
+
     # 3. 評価実行 (High Error Ground Truthの定義)
     if 'err_p95_m' not in df_merged.columns:
         print("Error: 'err_p95_m' column missing. Cannot evaluate.")
         return
 
-    thr = df_merged['err_p95_m'].quantile(HIGH_ERROR_QUANTILE)
-    df_merged['high_error'] = (df_merged['err_p95_m'] >= thr).astype(int)
+    # Series.quantileのディスパッチを通さず素の配列で閾値を出す
+    # (nanquantileはpandas同様に欠損を無視する)
+    err = df_merged['err_p95_m'].to_numpy(dtype=np.float64)
+    thr = np.nanquantile(err, HIGH_ERROR_QUANTILE)
+    df_merged['high_error'] = (err >= thr).astype(np.int8)
     
     print(f"High Error Threshold (top {100*(1-HIGH_ERROR_QUANTILE):.0f}%): {thr:.2f}m")
     
-    results = []
     # 評価対象の指標リスト
     targets = [
         ('risk_proxy_5m', 'Phase2 (Combined)'),
@@ -154,12 +284,11 @@ def run_phase2_evaluation(risk_csv_path, baseline_metrics_path, dop_csv_path, ou
     ]
     
     for col, name in targets:
-        if col in df_merged.columns:
-            res = calculate_safety_metrics(df_merged, 'high_error', col, name)
-            if res:
-                results.append(res)
-        else:
+        if col not in df_merged.columns:
             print(f"Skipping {name}: Column '{col}' not found.")
+    # 4スコアを1回のランク付けで一括評価する
+    results = [r for r in calculate_safety_metrics_batch(df_merged, 'high_error', targets)
+               if r is not None]
             
     # 4. 結果表示と保存
     if not results:
@@ -1,7 +1,33 @@
 import os
 import pandas as pd
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # バッチ実行専用: GUIバックエンドの初期化を省く
 import matplotlib.pyplot as plt
-from sklearn.metrics import roc_curve, roc_auc_score
+from sklearn.metrics import roc_curve
+
+# pyarrowがあればArrowエンジンでCSVを読む
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+def _read_csv(path):
+    """final_dataset.csv を読み込む（pyarrow利用時はマルチスレッドパーサ）。
+
+    run_phase2_evaluation が併置するParquetサイドカーがCSVより新しければ
+    そちらを優先する。
+    """
+    if HAS_PYARROW:
+        pq_path = os.path.splitext(path)[0] + '.parquet'
+        if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(path):
+            return pd.read_parquet(pq_path)
+        try:
+            return pd.read_csv(path, engine="pyarrow")
+        except (ValueError, TypeError):
+            pass
+    return pd.read_csv(path)
 
 def plot_roc_comparison(input_csv, output_dir):
     """
@@ -10,17 +36,15 @@ def plot_roc_comparison(input_csv, output_dir):
     """
     print("=========== ROC CURVE PLOTTING START ===========")
 
-    # 出力先ディレクトリ作成
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
-        print(f"[*] Created output directory: {output_dir}")
+    # 出力先ディレクトリ作成 (exist_ok=Trueなので存在チェックは不要)
+    os.makedirs(output_dir, exist_ok=True)
 
     # データ読み込み
     if not os.path.exists(input_csv):
         raise FileNotFoundError(f"Input file not found: {input_csv}")
 
     print(f"Loading data from: {input_csv}")
-    df = pd.read_csv(input_csv)
+    df = _read_csv(input_csv)
 
     # ==========================================
     # 1. データ準備 (Ground Truth)
@@ -48,7 +72,9 @@ def plot_roc_comparison(input_csv, output_dir):
     if 'risk_hybrid' in df.columns:
         score_p2 = df['risk_hybrid']
     elif 'overhead_flag' in df.columns and score_p1 is not None:
-        score_p2 = df.apply(lambda x: 1.0 if x.get('overhead_flag', 0) == 1 else x['risk_horizon'], axis=1)
+        # 行ごとのapply(Python呼び出し×N)ではなくnp.whereで一括計算
+        score_p2 = np.where(df['overhead_flag'].to_numpy() == 1, 1.0,
+                            df['risk_horizon'].to_numpy())
     else:
         print("[Warning] Cannot calculate Phase 2 score (missing columns).")
         score_p2 = None
@@ -65,22 +91,24 @@ def plot_roc_comparison(input_csv, output_dir):
     # ==========================================
     plt.figure(figsize=(8, 8))
 
+    # roc_auc_score を併用するとスコアごとに同じ配列を2回ソートすることに
+    # なるため、roc_curve の結果から台形則でAUCを導出する（同じ定義・同じ値）
     # --- Phase 2 (Proposed) ---
     if score_p2 is not None:
         fpr, tpr, _ = roc_curve(y_true, score_p2)
-        auc = roc_auc_score(y_true, score_p2)
+        auc = np.trapezoid(tpr, fpr)
         plt.plot(fpr, tpr, color='#d62728', lw=3, label=f'Phase 2 (Proposed): AUC={auc:.2f}')
 
     # --- Phase 1 (Baseline) ---
     if score_p1 is not None:
         fpr, tpr, _ = roc_curve(y_true, score_p1)
-        auc = roc_auc_score(y_true, score_p1)
+        auc = np.trapezoid(tpr, fpr)
         plt.plot(fpr, tpr, color='#1f77b4', linestyle='--', lw=2, label=f'Phase 1 (Building-Only): AUC={auc:.2f}')
 
     # --- HDOP (Benchmark) ---
     if score_hdop is not None:
         fpr, tpr, _ = roc_curve(y_true, score_hdop)
-        auc = roc_auc_score(y_true, score_hdop)
+        auc = np.trapezoid(tpr, fpr)
         plt.plot(fpr, tpr, color='gray', linestyle=':', lw=2, label=f'HDOP (Benchmark): AUC={auc:.2f}')
 
     # ランダム推測線
